@@ -2,10 +2,14 @@ import os
 import pytest
 import utils
 import random
-import time
 import logging
 
+from utils import graph
+from utils import image
 from utils import os_client
+from utils import persistent
+from utils import ssh
+from utils import topology
 
 
 logger = logging.getLogger(__name__)
@@ -20,28 +24,199 @@ def openstack_clients():
         auth_url=os.environ['OS_AUTH_URL'],
         cert=False,
         domain=os.environ['OS_PROJECT_DOMAIN_NAME'],
+        pool_maxsize=utils.get_configuration().http_pool_maxsize,
         )
 
 
-nodes = utils.get_pairs()
+@pytest.fixture(scope='session', autouse=True)
+def ssh_connections():
+    yield ssh.connection_pool
+    # close the SSH connections pooled during the session
+    ssh.connection_pool.close()
 
 
-@pytest.fixture(scope='session', params=list(nodes.values()),
-                ids=list(nodes.keys()))
+# the tests with the pair which are replaced by test_vm2vm_round with
+# the 'rounds' scheduler, the other pair tests test the pairs one by one
+# with any scheduler
+ROUND_REPLACED_TESTS = ('test_vm2vm',)
+
+
+def _skip_param(reason):
+    return pytest.param(None, id='skipped',
+                        marks=pytest.mark.skip(reason=reason))
+
+
+def pytest_generate_tests(metafunc):
+    """Discover the compute pairs only when some collected test uses them,
+    other tests do not need the Nova API."""
+    scheduler = utils.get_configuration().pair_scheduler
+    if 'pair' in metafunc.fixturenames:
+        if scheduler == 'rounds' and \
+                metafunc.function.__name__ in ROUND_REPLACED_TESTS:
+            metafunc.parametrize('pair', [_skip_param(
+                "pair_scheduler is 'rounds', the pairs are tested "
+                "by test_vm2vm_round")], indirect=True, scope='session')
+        else:
+            nodes = utils.get_pairs()
+            metafunc.parametrize('pair', list(nodes.values()),
+                                 ids=list(nodes.keys()), indirect=True,
+                                 scope='session')
+    if 'pair_round' in metafunc.fixturenames:
+        if scheduler == 'rounds':
+            rounds = utils.get_rounds()
+            metafunc.parametrize('pair_round', list(rounds.values()),
+                                 ids=list(rounds.keys()), indirect=True,
+                                 scope='session')
+        else:
+            metafunc.parametrize('pair_round', [_skip_param(
+                "pair_scheduler is 'serial', the pairs are "
+                "tested by test_vm2vm")], indirect=True, scope='session')
+
+
+@pytest.fixture(scope='session')
 def pair(request):
     return request.param
 
 
+@pytest.fixture(scope='session')
+def pair_round(request):
+    return request.param
+
+
+def _create_os_resources(os_actions, config, warm=None):
+    """Create the resources concurrently where the dependencies allow.
+    :param warm: persistent.PersistentResources to reuse the resources of
+    the previous runs
+    :return: dict of the task name: created resource
+    :raises graph.GraphError: with the resources created before the error
+    """
+    os_clients = os_actions.os_clients
+
+    def get_flavor(_):
+        flavors = [flavor.id for flavor in os_clients.compute.flavors.list()
+                   if flavor.name == config.flavor_name]
+        if flavors:
+            return str(flavors[0]), False
+        return os_actions.create_flavor(
+            config.flavor_name, config.flavor_ram, config.flavor_vcpus,
+            config.flavor_disk).id, True
+
+    tasks = {
+        'flavor': (get_flavor, []),
+        'sec_group': (lambda r: os_actions.create_sec_group(), []),
+        'keypair': (lambda r: os_clients.compute.keypairs.create(
+            '{}-{}'.format('spt-key', random.randrange(100, 999))), []),
+        'ext_net': (lambda r: os_actions.get_external_network(), []),
+        'tenant': (lambda r: os_actions.get_admin_tenant(), []),
+        'net1': (lambda r: os_actions.create_network(r['tenant'].id),
+                 ['tenant']),
+        'subnet1': (lambda r: os_actions.create_subnet(
+            r['net1'], r['tenant'].id)['id'], ['net1']),
+        'net2': (lambda r: os_actions.create_network(r['tenant'].id),
+                 ['tenant']),
+        'subnet2': (lambda r: os_actions.create_subnet(
+            r['net2'], r['tenant'].id, '10.2.7.0/24'), ['net2']),
+        'router': (lambda r: os_actions.create_router(
+            r['ext_net'], r['tenant'].id), ['ext_net', 'tenant']),
+        'interface1': (lambda r: os_clients.network.add_interface_router(
+            r['router']['id'], {'subnet_id': r['subnet1']}),
+            ['router', 'subnet1']),
+        # the router is updated by one request at a time to avoid conflicts
+        'interface2': (lambda r: os_clients.network.add_interface_router(
+            r['router']['id'], {'subnet_id': r['subnet2']['id']}),
+            ['router', 'subnet2', 'interface1']),
+    }
+    if warm is not None:
+        tasks.update({
+            'sec_group': (lambda r: warm.sec_group(), []),
+            'ext_net': (lambda r: warm.ext_net(), []),
+            'keypair': (lambda r: warm.keypair(), []),
+            'net1': (lambda r: warm.network(1, r['tenant'].id), ['tenant']),
+            'subnet1': (lambda r: warm.subnet(
+                r['net1'], r['tenant'].id, '10.1.7.0/24')['id'], ['net1']),
+            'net2': (lambda r: warm.network(2, r['tenant'].id), ['tenant']),
+            'subnet2': (lambda r: warm.subnet(
+                r['net2'], r['tenant'].id, '10.2.7.0/24'), ['net2']),
+            'router': (lambda r: warm.router(r['ext_net'], r['tenant'].id),
+                       ['ext_net', 'tenant']),
+            'interface1': (lambda r: warm.router_interface(
+                r['router'], r['subnet1']), ['router', 'subnet1']),
+            'interface2': (lambda r: warm.router_interface(
+                r['router'], r['subnet2']['id']),
+                ['router', 'subnet2', 'interface1']),
+        })
+    return graph.run_graph(tasks)
+
+
+def _delete_os_resources(os_actions, created, timeout=300):
+    """Delete the resources concurrently in the reverse dependency order,
+    the networks and the security group are deleted once their ports are
+    gone."""
+    network = os_actions.os_clients.network
+    compute = os_actions.os_clients.compute
+    tasks = {}
+    router_deps = []
+    if 'router' in created:
+        router_id = created['router']['id']
+        if 'interface1' in created:
+            tasks['remove_interface1'] = (
+                lambda r: network.remove_interface_router(
+                    router_id, {'subnet_id': created['subnet1']}), [])
+            router_deps.append('remove_interface1')
+        if 'interface2' in created:
+            tasks['remove_interface2'] = (
+                lambda r: network.remove_interface_router(
+                    router_id, {'subnet_id': created['subnet2']['id']}),
+                list(router_deps))
+            router_deps.append('remove_interface2')
+        tasks['remove_gateway'] = (
+            lambda r: network.remove_gateway_router(router_id),
+            list(router_deps))
+
+        def delete_router(_):
+            # HA ports are deleted together with the router
+            os_actions.wait_for_ports_deleted(
+                timeout=timeout, device_id=router_id,
+                ignored_owners=('network:router_ha_interface',))
+            network.delete_router(router_id)
+        tasks['delete_router'] = (delete_router, ['remove_gateway'])
+        router_deps = ['delete_router']
+
+    def delete_network(net_id):
+        def delete(_):
+            # wait for the ports of the deleted VMs and the router
+            os_actions.wait_for_ports_deleted(timeout=timeout,
+                                              network_id=net_id)
+            network.delete_network(net_id)
+        return delete
+
+    net_tasks = []
+    for net in ('net1', 'net2'):
+        if net in created:
+            tasks['delete_' + net] = (delete_network(created[net]['id']),
+                                      router_deps)
+            net_tasks.append('delete_' + net)
+    if 'sec_group' in created:
+        tasks['delete_sec_group'] = (
+            lambda r: compute.security_groups.delete(created['sec_group'].id),
+            net_tasks)
+    if 'keypair' in created:
+        tasks['delete_keypair'] = (
+            lambda r: compute.keypairs.delete(created['keypair'].name), [])
+    if 'flavor' in created and created['flavor'][1]:
+        tasks['delete_flavor'] = (
+            lambda r: compute.flavors.delete(created['flavor'][0]), [])
+    if 'ext_net' in created and os_actions.create_fake_ext_net:
+        tasks['delete_ext_net'] = (
+            delete_network(created['ext_net']['id']), router_deps)
+    graph.run_graph(tasks)
+
+
 @pytest.fixture(scope='session')
 def os_resources(openstack_clients):
     os_actions = os_client.OSCliActions(openstack_clients)
-    os_resource = {}
     config = utils.get_configuration()
-    image_name = config.get('image_name', 'Ubuntu-18.04')
-    flavor_name = config.get('flavor_name', 'spt-test')
-    flavor_ram = config.get('flavor_ram', 1536)
-    flavor_vcpus = config.get('flavor_vcpus', 1)
-    flavor_disk = config.get('flavor_disk', 3)
+    image_name = config.image_name
 
     os_images_list = [image.id for image in
                       openstack_clients.image.images.list(
@@ -51,61 +226,73 @@ def os_resources(openstack_clients):
         pytest.skip("No images with name {}. This name can be redefined "
                     "with 'image_name' env var ".format(image_name))
 
-    os_resource['image_id'] = str(os_images_list[0])
-
-    os_resource['flavor_id'] = [flavor.id for flavor in
-                                openstack_clients.compute.flavors.list()
-                                if flavor.name == flavor_name]
-    flavor_is_created = False
-    if not os_resource['flavor_id']:
-        os_resource['flavor_id'] = os_actions.create_flavor(
-            flavor_name, flavor_ram, flavor_vcpus, flavor_disk).id
-        flavor_is_created = True
-    else:
-        os_resource['flavor_id'] = str(os_resource['flavor_id'][0])
-
-    os_resource['sec_group'] = os_actions.create_sec_group()
-    os_resource['keypair'] = openstack_clients.compute.keypairs.create(
-        '{}-{}'.format('spt-key', random.randrange(100, 999))
-    )
-    os_resource['net1'] = os_actions.create_network_resources()
-    os_resource['ext_net'] = os_actions.get_external_network()
-    adm_tenant = os_actions.get_admin_tenant()
-    os_resource['router'] = os_actions.create_router(
-        os_resource['ext_net'], adm_tenant.id)
-    os_resource['net2'] = os_actions.create_network(adm_tenant.id)
-    os_resource['subnet2'] = os_actions.create_subnet(
-        os_resource['net2'], adm_tenant.id, '10.2.7.0/24')
-    for subnet in openstack_clients.network.list_subnets()['subnets']:
-        if subnet['network_id'] == os_resource['net1']['id']:
-            os_resource['subnet1'] = subnet['id']
-
-    openstack_clients.network.add_interface_router(
-        os_resource['router']['id'],{'subnet_id': os_resource['subnet1']})
-    openstack_clients.network.add_interface_router(
-        os_resource['router']['id'],
-        {'subnet_id': os_resource['subnet2']['id']})
+    warm = None
+    if config.persistent_resources:
+        warm = persistent.PersistentResources(os_actions,
+                                              config.persistent_state_dir)
+    try:
+        created = _create_os_resources(os_actions, config, warm=warm)
+    except graph.GraphError as e:
+        if warm is not None:
+            raise
+        logger.error("Could not create resources, deleting the created "
+                     "ones...")
+        _delete_os_resources(os_actions, e.results,
+                             timeout=config.nova_timeout)
+        raise
+
+    os_resource = {
+        'image_id': str(os_images_list[0]),
+        'flavor_id': created['flavor'][0],
+        'sec_group': created['sec_group'],
+        'keypair': created['keypair'],
+        'net1': created['net1'],
+        'subnet1': created['subnet1'],
+        'ext_net': created['ext_net'],
+        'router': created['router'],
+        'net2': created['net2'],
+        'subnet2': created['subnet2'],
+        'persistent': warm,
+    }
+    if config.iperf_image_prebuilt:
+        try:
+            os_resource['image_id'] = image.get_prebuilt_image(
+                openstack_clients, os_resource, os_resource['image_id'],
+                timeout=config.nova_timeout)
+        except Exception:
+            if warm is not None:
+                raise
+            logger.error("Could not build the image, deleting the created "
+                         "resources...")
+            _delete_os_resources(os_actions, created,
+                                 timeout=config.nova_timeout)
+            raise
     yield os_resource
 
+    if warm is not None:
+        logger.info("Persistent mode, the resources are kept for the next "
+                    "runs.")
+        return
     # cleanup created resources
     logger.info("Deleting routers, networks, SG, key pair, flavor...")
-    openstack_clients.network.remove_interface_router(
-        os_resource['router']['id'], {'subnet_id': os_resource['subnet1']})
-    openstack_clients.network.remove_interface_router(
-        os_resource['router']['id'],
-        {'subnet_id': os_resource['subnet2']['id']})
-    openstack_clients.network.remove_gateway_router(
-        os_resource['router']['id'])
-    time.sleep(5)
-    openstack_clients.network.delete_router(os_resource['router']['id'])
-    time.sleep(5)
-    openstack_clients.network.delete_network(os_resource['net1']['id'])
-    openstack_clients.network.delete_network(os_resource['net2']['id'])
-
-    openstack_clients.compute.security_groups.delete(
-        os_resource['sec_group'].id)
-    openstack_clients.compute.keypairs.delete(os_resource['keypair'].name)
-    if flavor_is_created:
-        openstack_clients.compute.flavors.delete(os_resource['flavor_id'])
-    if os_actions.create_fake_ext_net:
-        openstack_clients.network.delete_network(os_resource['ext_net']['id'])
+    _delete_os_resources(os_actions, created, timeout=config.nova_timeout)
+
+
+@pytest.fixture(scope='session')
+def pair_topology(openstack_clients, pair, os_resources):
+    """VMs of the pair shared by the tests which measure the pair one after
+    another (sweep, UDP, latency). They are created by the first of them
+    and deleted after the last one. The tests get it with
+    request.getfixturevalue('pair_topology') once they are not skipped,
+    so the skipped tests do not boot the VMs."""
+    config = utils.get_configuration()
+    vms = topology.PairTopology(openstack_clients, pair, os_resources)
+    try:
+        vms.create(nova_timeout=config.nova_timeout,
+                   ssh_timeout=config.ssh_timeout,
+                   vm_prepare_workers=config.vm_prepare_workers)
+    except Exception:
+        vms.delete(timeout=config.nova_timeout)
+        raise
+    yield vms
+    vms.delete(timeout=config.nova_timeout)
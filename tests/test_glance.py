@@ -1,31 +1,25 @@
+import json
 import pytest
 import time
 import subprocess
 import random
 import logging
 
+from texttable import Texttable
+
 import utils
+from utils import glance
 
 logger = logging.getLogger(__name__)
 
 
-def is_parsable(value, to):
-    """
-    Check if value can be converted into some type
-    :param value:  input value that should be converted
-    :param to: type of output value like int, float. It's not a string!
-    :return: bool
-    """
-    try:
-        to(value)
-    except:
-        return False
-    return True
-
-
 @pytest.fixture
 def create_image():
-    image_size_megabytes = utils.get_configuration().get("IMAGE_SIZE_MB", 2000)
+    if utils.get_configuration().IMAGE_STREAMING:
+        # the image data is generated while uploading, no local file
+        yield True
+        return
+    image_size_megabytes = utils.get_configuration().IMAGE_SIZE_MB
     create_file_cmdline = 'dd if=/dev/zero of=/tmp/image_mk_framework.dd ' \
                           'bs=1M count={} 2>/dev/null' \
                           ''.format(image_size_megabytes)
@@ -46,12 +40,13 @@ def test_speed_glance(create_image, openstack_clients, record_property):
     2. Upload data as image to glance.
     3. Download image.
     4. Measure download/upload speed and print them into stdout
+    With IMAGE_STREAMING the data is generated in memory while uploading
+    and the downloaded data is discarded, so the local disk is not used.
     """
-    image_size_megabytes = utils.get_configuration().get("IMAGE_SIZE_MB")
-    if not is_parsable(image_size_megabytes, int):
-        pytest.fail("Can't convert IMAGE_SIZE_MB={} to 'int'".format(
-            image_size_megabytes))
-    image_size_megabytes = int(image_size_megabytes)
+    config = utils.get_configuration()
+    streaming = config.IMAGE_STREAMING
+    verify_checksum = config.IMAGE_VERIFY_CHECKSUM
+    image_size_megabytes = config.IMAGE_SIZE_MB
     if not create_image:
         pytest.skip("Can't create image, maybe there is lack of disk "
                     "space to create file {}MB".
@@ -70,10 +65,18 @@ def test_speed_glance(create_image, openstack_clients, record_property):
                     "".format(e))
 
     logger.info("Testing upload file speed...")
+    if streaming:
+        image_data = glance.ImageDataStream(
+            image_size_megabytes * 1024 * 1024, checksum=verify_checksum)
+    else:
+        image_data = open("/tmp/image_mk_framework.dd", 'rb')
+    upload_timeline = glance.TransferTimeline(with_ttfb=False)
     start_time = time.time()
+    upload_timeline.begin()
     try:
         openstack_clients.image.images.upload(
-            image.id, image_data=open("/tmp/image_mk_framework.dd", 'rb'))
+            image.id,
+            image_data=glance.TimedReader(image_data, upload_timeline))
     except BaseException as e:
         pytest.fail("Can't upload image in Glance. "
                     "Occurred error: {}".format(e))
@@ -82,19 +85,131 @@ def test_speed_glance(create_image, openstack_clients, record_property):
     speed_upload = image_size_megabytes / (end_time - start_time)
 
     logger.info("Testing download file speed...")
+    download_timeline = glance.TransferTimeline()
     start_time = time.time()
-    with open("/tmp/image_mk_framework.download", 'wb') as image_file:
-        for item in openstack_clients.image.images.data(image.id):
-            image_file.write(item)
+    download_timeline.begin()
+    if streaming:
+        # glanceclient checksum is not needed, it is verified here if asked
+        downloaded_size, checksum = glance.discard(
+            glance.timed_chunks(openstack_clients.image.images.data(
+                image.id, do_checksum=False), download_timeline),
+            checksum=verify_checksum)
+    else:
+        with open("/tmp/image_mk_framework.download", 'wb') as image_file:
+            for item in glance.timed_chunks(
+                    openstack_clients.image.images.data(image.id),
+                    download_timeline):
+                image_file.write(item)
     end_time = time.time()
 
     speed_download = image_size_megabytes / (end_time - start_time)
     logger.info("Deleted image {}.".format(image.id))
     openstack_clients.image.images.delete(image.id)
+    if streaming:
+        if downloaded_size != len(image_data):
+            pytest.fail("Downloaded {} bytes, but uploaded {} bytes".format(
+                downloaded_size, len(image_data)))
+        if verify_checksum and checksum != image_data.hexdigest():
+            pytest.fail("Downloaded data checksum {} does not match the "
+                        "uploaded one {}".format(checksum,
+                                                 image_data.hexdigest()))
     record_property("Upload", speed_upload)
     record_property("Download", speed_download)
+    report = {'upload': upload_timeline.summary(),
+              'download': download_timeline.summary()}
+    for direction, summary in report.items():
+        for key in ('ttfb_s', 'chunk_latency_p50_ms', 'chunk_latency_p90_ms',
+                    'chunk_latency_p99_ms', 'chunk_latency_p100_ms'):
+            if key in summary:
+                record_property("{} {}".format(direction.capitalize(), key),
+                                summary[key])
+    report_path = config.GLANCE_REPORT_PATH
+    if report_path:
+        with open(report_path, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+        logger.info("Saved the transfers report to {}".format(report_path))
 
     print("++++++++++++++++++++++++++++++++++++++++")
     print(('upload - {} MB/s'.format(speed_upload)))
     print(('download - {} MB/s'.format(speed_download)))
+    for direction, summary in report.items():
+        ttfb = "time to first byte {:.3f} s, ".format(
+            summary['ttfb_s'] or 0) if 'ttfb_s' in summary else ""
+        print("{} - {}chunk latency p50/p99/max {}/{}/{} ms".format(
+            direction, ttfb,
+            *["{:.1f}".format(summary[key] or 0) for key in (
+                'chunk_latency_p50_ms', 'chunk_latency_p99_ms',
+                'chunk_latency_p100_ms')]))
     print("++++++++++++++++++++++++++++++++++++++++")
+
+
+def test_speed_glance_concurrent(openstack_clients, record_property):
+    """
+    Concurrent Performance Tests Download / upload Glance
+    For each count of streams N from GLANCE_CONCURRENCY:
+    1. Create N images, upload generated data to all of them at once
+    2. Download all N images at once, the data is discarded
+    3. Measure aggregate and per-stream download/upload speed
+    4. Delete the images
+    Print the table with the speeds and the count of streams after which
+    the aggregate speed stops scaling.
+    """
+    config = utils.get_configuration()
+    if not config.GLANCE_CONCURRENCY:
+        pytest.skip("GLANCE_CONCURRENCY is not set, e.g. [1, 2, 4, 8, 16]")
+    concurrency = sorted(set(config.GLANCE_CONCURRENCY))
+    image_size = config.GLANCE_CONCURRENT_IMAGE_SIZE_MB * 1024 * 1024
+    image_client = openstack_clients.image
+
+    runs = {'upload': [], 'download': []}
+    for streams in concurrency:
+        images = []
+        try:
+            for _ in range(streams):
+                images.append(image_client.images.create(
+                    name="spt-test-image-{}".format(
+                        random.randrange(100, 999)),
+                    disk_format='iso',
+                    container_format='bare'))
+            logger.info("Testing upload speed with {} streams...".format(
+                streams))
+            transfers = glance.run_concurrently(
+                glance.upload,
+                [(image_client, image.id, image_size) for image in images])
+            runs['upload'].append(
+                glance.summarize(streams, 'upload', transfers))
+            logger.info("Testing download speed with {} streams...".format(
+                streams))
+            transfers = glance.run_concurrently(
+                glance.download,
+                [(image_client, image.id) for image in images])
+            runs['download'].append(
+                glance.summarize(streams, 'download', transfers))
+        except BaseException as e:
+            pytest.fail("Concurrent transfer with {} streams failed. "
+                        "Occurred error: {}".format(streams, e))
+        finally:
+            for image in images:
+                image_client.images.delete(image.id)
+            logger.info("Deleted {} images.".format(len(images)))
+
+    table = Texttable()
+    table.add_row(['Streams', 'Direction', 'Aggregate, MB/s',
+                   'Per stream, MB/s'])
+    for direction in ('upload', 'download'):
+        for run in runs[direction]:
+            table.add_row([run.streams, direction,
+                           "{:.2f}".format(run.aggregate_mbps),
+                           "{:.2f}".format(run.per_stream_mbps)])
+            record_property("{} {} streams".format(direction, run.streams),
+                            run.aggregate_mbps)
+    print(table.draw())
+    for direction in ('upload', 'download'):
+        limit = glance.scaling_limit(runs[direction])
+        record_property("{} scaling limit".format(direction), limit)
+        if limit is None:
+            print("{} scales up to {} streams".format(
+                direction, concurrency[-1]))
+        else:
+            print("{} stops scaling after {} streams".format(
+                direction, limit))
@@ -0,0 +1,24 @@
+import pytest
+
+from utils import latency
+
+
+@pytest.mark.parametrize('exponent', range(1, 40))
+def test_histogram_bucket_powers_of_two(exponent):
+    """A power of two starts its own range, the float just below it ends
+    the previous range."""
+    histogram = latency.LatencyHistogram()
+    value = 2 ** exponent
+    assert histogram._get_bucket(value) == (exponent + 1, 0)
+    assert histogram._get_bucket(float(value)) == (exponent + 1, 0)
+    assert histogram._get_bucket(value * (1 - 2.0 ** -52)) == \
+        (exponent, histogram.sub_buckets - 1)
+
+
+def test_histogram_percentile_bounds():
+    """The upper bound of the bucket is within 1 / sub_buckets of the
+    value."""
+    histogram = latency.LatencyHistogram()
+    for value in (1, 3, 1000, 1024, 4095.5, 4096, 123456.7):
+        bound = histogram._get_upper_bound(histogram._get_bucket(value))
+        assert value < bound <= value * (1 + 1.0 / histogram.sub_buckets)
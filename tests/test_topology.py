@@ -0,0 +1,39 @@
+from unittest import mock
+
+import pytest
+
+from utils import topology
+
+
+def get_fabric(host_count, vms_per_host):
+    os_resources = {'keypair': mock.Mock(private_key='key')}
+    return topology.FabricTopology(
+        mock.Mock(), ['cmp{:03d}'.format(i) for i in range(host_count)],
+        os_resources, vms_per_host=vms_per_host)
+
+
+@pytest.mark.parametrize('host_count,vms_per_host',
+                         [(2, 1), (2, 3), (4, 3), (5, 4), (8, 2)])
+def test_fabric_flows_spread(host_count, vms_per_host):
+    """Each VM sends and receives one flow, no flow stays inside a host,
+    and the VMs of a host send to min(vms_per_host, hosts - 1) different
+    hosts."""
+    fabric = get_fabric(host_count, vms_per_host)
+    flows = fabric.get_flows()
+    assert len(flows) == host_count * vms_per_host
+    assert sorted(client for client, _ in flows) == \
+        list(range(len(flows)))
+    assert sorted(server for _, server in flows) == \
+        list(range(len(flows)))
+    destinations = {}
+    for client, server in flows:
+        assert fabric.host(client) != fabric.host(server)
+        destinations.setdefault(fabric.host(client), set()).add(
+            fabric.host(server))
+    for host_destinations in destinations.values():
+        assert len(host_destinations) == min(vms_per_host, host_count - 1)
+
+
+def test_fabric_flows_need_two_hosts():
+    with pytest.raises(ValueError):
+        get_fabric(1, 2).get_flows()
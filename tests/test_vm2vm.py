@@ -1,16 +1,166 @@
 import logging
-import time
+from concurrent import futures
 
 import pytest
 from texttable import Texttable
 
 import utils
-from utils import os_client
-from utils import ssh
+from utils import iperf
+from utils import latency
+from utils import sweep
+from utils import topology
 
 
 logger = logging.getLogger(__name__)
 
+# (description, server VM index, server address key, iperf3 options)
+# vm1 is the iperf3 client in all the measurements
+MEASUREMENTS = [
+    ('VM to VM in same tenant on same node via Private IP, 1 thread',
+     1, 'private_address', ''),
+    ('VM to VM in same tenant on different HW nodes via Private IP, '
+     '1 thread', 2, 'private_address', ''),
+    ('VM to VM in same tenant on different HW nodes via Private IP, '
+     '10 threads', 2, 'private_address', '-P 10'),
+    ('VM to VM in same tenant via Floating IP and VMs are on different '
+     'nodes, 1 thread', 2, 'fip', ''),
+    ('VM to VM in same tenant, different HW nodes and each VM is connected '
+     'to separate network which are connected using Router via Private '
+     'IP, 1 thread', 3, 'private_address', ''),
+]
+
+
+def measure(transport, server, iperf_time, options='', adaptive=None):
+    if adaptive:
+        return iperf.run_iperf_adaptive(
+            transport, server, max_time=iperf_time, options=options,
+            **adaptive)
+    return iperf.run_iperf(transport, server, iperf_time=iperf_time,
+                           options=options)
+
+
+def measure_bidir(pair_topology, index, address_key, iperf_time,
+                  options=''):
+    """vm1 and the server VM send to each other at the same time, each
+    of them is the iperf3 client of the other one. The duration is fixed,
+    so both directions overlap for the whole measurement.
+    :return: tuple of the results from vm1 and to vm1
+    """
+    vm1 = pair_topology.vm_info[0][address_key]
+    server = pair_topology.vm_info[index][address_key]
+    with futures.ThreadPoolExecutor(max_workers=2) as executor:
+        forward = executor.submit(iperf.run_iperf, pair_topology.transport(0),
+                                  server, iperf_time, options)
+        backward = executor.submit(iperf.run_iperf,
+                                   pair_topology.transport(index), vm1,
+                                   iperf_time, options)
+        return forward.result(), backward.result()
+
+
+def measure_pair(pair_topology, iperf_time, adaptive=None,
+                 directions=('forward', 'reverse', 'bidir')):
+    """Run the iperf3 measurements at the prepared topology.
+    :param adaptive: dict with min_time and ci_percent to stop the
+    measurements on convergence, iperf_time is the max duration then
+    :param directions: 'forward' - from vm1 to the server VM, 'reverse' -
+    from the server VM to vm1 (iperf3 -R), 'bidir' - both at once
+    :return: list of dicts with the measurement name, hosts and
+    iperf.IperfResult of the directions, None for the skipped ones
+    """
+    transport1 = pair_topology.transport(0)
+    results = []
+    for i, (name, index, address_key, options) in enumerate(MEASUREMENTS):
+        server = pair_topology.vm_info[index][address_key]
+        item = {'result': None, 'reverse': None, 'bidir': None}
+        if 'forward' in directions:
+            logger.info("Doing '{}' measurement...".format(name))
+            item['result'] = measure(transport1, server, iperf_time,
+                                     options, adaptive)
+        if 'reverse' in directions:
+            logger.info("Doing '{}' measurement in reverse...".format(name))
+            item['reverse'] = measure(transport1, server, iperf_time,
+                                      " ".join(filter(None, [options, '-R'])),
+                                      adaptive)
+        if 'bidir' in directions:
+            logger.info("Doing '{}' measurement in both directions..."
+                        "".format(name))
+            item['bidir'] = measure_bidir(pair_topology, index, address_key,
+                                          iperf_time, options)
+        logger.info("Result #{} is {} / {}".format(
+            i + 1, *[iperf.format_bandwidth(
+                item[key].bits_per_second if item[key] else None)
+                for key in ('result', 'reverse')]))
+        host1, host2 = pair_topology.hosts(index)
+        item.update({'name': name, 'host1': host1, 'host2': host2})
+        results.append(item)
+    return results
+
+
+def run_pair(openstack_clients, pair, os_resources, record_property=None):
+    """Create the VMs at the pair, measure and delete the VMs."""
+    config = utils.get_configuration()
+    pair_topology = topology.PairTopology(openstack_clients, pair,
+                                          os_resources)
+    try:
+        pair_topology.create(
+            nova_timeout=config.nova_timeout,
+            ssh_timeout=config.ssh_timeout,
+            vm_prepare_workers=config.vm_prepare_workers)
+        if record_property is not None:
+            pair_topology.record_ssh_times(record_property)
+        adaptive = None
+        if config.iperf_adaptive:
+            adaptive = {'min_time': config.iperf_min_time,
+                        'ci_percent': config.iperf_ci_percent}
+        return measure_pair(pair_topology, config.iperf_time,
+                            adaptive=adaptive,
+                            directions=config.iperf_directions)
+    finally:
+        pair_topology.delete(timeout=config.nova_timeout)
+
+
+def get_bandwidth(result):
+    return result.bits_per_second if result is not None else None
+
+
+def draw_results(results, record_property):
+    """'bandwidth >' is from vm1 to the server VM, 'bandwidth <' is back
+    to vm1, 'bidirectional' are both of them measured at the same time."""
+    logger.info("Drawing the table with iperf results...")
+    table_rows = [['Test Case', 'Host 1', 'Host 2', 'bandwidth >',
+                   'bandwidth <', 'bidirectional > / <', 'Retransmits']]
+    for item in results:
+        bidir = item['bidir'] or (None, None)
+        bandwidths = {
+            '': get_bandwidth(item['result']),
+            ' reverse': get_bandwidth(item['reverse']),
+            ' bidirectional >': get_bandwidth(bidir[0]),
+            ' bidirectional <': get_bandwidth(bidir[1]),
+        }
+        table_rows.append([
+            item['name'], item['host1'], item['host2'],
+            iperf.format_bandwidth(bandwidths['']),
+            iperf.format_bandwidth(bandwidths[' reverse']),
+            "{} / {}".format(
+                iperf.format_bandwidth(bandwidths[' bidirectional >']),
+                iperf.format_bandwidth(bandwidths[' bidirectional <'])),
+            item['result'].retransmits if item['result'] else None])
+        for suffix, bandwidth in bandwidths.items():
+            if bandwidth is not None:
+                record_property("{} {}<>{}{}".format(
+                    item['name'], item['host1'], item['host2'], suffix),
+                    bandwidth)
+        for suffix, key in (('', 'result'), (' reverse', 'reverse')):
+            result = item[key]
+            if result is not None and \
+                    result.stop_reason != 'fixed duration':
+                record_property("{} {}<>{}{} stop reason".format(
+                    item['name'], item['host1'], item['host2'], suffix),
+                    result.stop_reason)
+    result_table = Texttable()
+    result_table.add_rows(table_rows)
+    print((result_table.draw()))
+
 
 def test_vm2vm(openstack_clients, pair, os_resources, record_property):
     """
@@ -24,175 +174,283 @@ def test_vm2vm(openstack_clients, pair, os_resources, record_property):
     7. Measure VM to VM on different HW nodes via Floating IP, 1 thread
     8. Measure VM to VM on different HW nodes, each VM is in separate network,
        the networks are connected using Router via Private IP, 1 thread
+       Each measurement is done from vm1, back to vm1 and in both
+       directions at the same time (see 'iperf_directions')
     9. Draw the table with all pairs and results
     """
-    os_actions = os_client.OSCliActions(openstack_clients)
+    try:
+        draw_results(run_pair(openstack_clients, pair, os_resources,
+                              record_property), record_property)
+    except Exception as e:
+        print(e)
+        print("Something went wrong")
+        pytest.fail("Something went wrong")
+
+
+def test_vm2vm_round(openstack_clients, pair_round, os_resources,
+                     record_property):
+    """
+    VM to VM test for all the pairs of the round at the same time
+    The pairs of the round do not share compute hosts. Each pair is
+    tested like in test_vm2vm, at most 'pairs_concurrency' pairs are
+    tested concurrently.
+    1. Create 4 VMs at each pair, prepare iperf3 and measure
+    2. Draw the table with all pairs and results
+    """
+    concurrency = utils.get_configuration().pairs_concurrency
+    results = []
+    errors = {}
+    with futures.ThreadPoolExecutor(
+            max_workers=max(min(concurrency, len(pair_round)), 1)) \
+            as executor:
+        tasks = {executor.submit(run_pair, openstack_clients, pair,
+                                 os_resources, record_property): pair_id
+                 for pair_id, pair in pair_round.items()}
+        for task in futures.as_completed(tasks):
+            try:
+                results.extend(task.result())
+            except Exception as e:
+                logger.error("Pair {} failed: {}".format(tasks[task], e))
+                errors[tasks[task]] = e
+    if results:
+        draw_results(results, record_property)
+    if errors:
+        for pair_id, e in errors.items():
+            print("{}: {}".format(pair_id, e))
+        pytest.fail("Something went wrong at {} of {} pairs".format(
+            len(errors), len(pair_round)))
+
+
+def test_vm2vm_saturation(openstack_clients, os_resources, record_property):
+    """
+    Fabric saturation test: many VM to VM flows through the fabric at once
+    1. Create 'saturation_vms_per_host' VMs at each of 'saturation_hosts'
+       compute hosts, in the same network
+    2. VM i at each host sends to VM i at a different host (the i+1-th
+       next one), all the iperf3 clients are started at the same moment
+    3. Draw the table with the flows, the aggregate throughput and the
+       fairness across the flows
+    """
     config = utils.get_configuration()
-    timeout = int(config.get('nova_timeout', 30))
-    iperf_time = int(config.get('iperf_time', 60))
-    private_key = os_resources['keypair'].private_key
-    ssh_timeout = int(config.get('ssh_timeout', 500))
+    if not config.saturation_vms_per_host:
+        pytest.skip("saturation_vms_per_host is not set")
+    hosts = utils.get_hosts()
+    if config.saturation_hosts:
+        hosts = hosts[:config.saturation_hosts]
+    if len(hosts) < 2:
+        pytest.skip("At least 2 compute hosts are needed, got {}".format(
+            len(hosts)))
+    flow_count = len(hosts) * config.saturation_vms_per_host
+    if flow_count > iperf.MAX_SYNCHRONIZED_FLOWS:
+        pytest.skip("{} flows are more than {} which can be started at "
+                    "once, decrease saturation_hosts or "
+                    "saturation_vms_per_host".format(
+                        flow_count, iperf.MAX_SYNCHRONIZED_FLOWS))
+    fabric = topology.FabricTopology(
+        openstack_clients, hosts, os_resources,
+        vms_per_host=config.saturation_vms_per_host)
+    try:
+        fabric.create(nova_timeout=config.nova_timeout,
+                      ssh_timeout=config.ssh_timeout,
+                      vm_prepare_workers=config.vm_prepare_workers)
+        fabric.record_ssh_times(record_property)
+        flows = fabric.get_flows()
+        logger.info("Starting {} flows across {} hosts at once...".format(
+            len(flows), len(hosts)))
+        results = iperf.run_synchronized(
+            [(fabric.transport(client),
+              fabric.vm_info[server]['private_address'])
+             for client, server in flows],
+            iperf_time=config.iperf_time,
+            options=config.saturation_options)
+    except Exception as e:
+        print(e)
+        pytest.fail("Something went wrong")
+    finally:
+        fabric.delete(timeout=config.nova_timeout)
+
+    table_rows = [['Host 1', 'Host 2', 'Result', 'Retransmits']]
+    for (client, server), result in zip(flows, results):
+        table_rows.append([fabric.host(client), fabric.host(server),
+                           iperf.format_bandwidth(result.bits_per_second),
+                           result.retransmits])
+    summary = iperf.summarize_flows(results)
+    for key, value in summary.items():
+        record_property(key, value)
     result_table = Texttable()
+    result_table.add_rows(table_rows)
+    print(result_table.draw())
+    print("{} flows across {} hosts: aggregate {}, per flow min {} / mean "
+          "{} / max {}, Jain's fairness index {:.3f}, spread {:.1%}".format(
+              summary['flows'], len(hosts),
+              iperf.format_bandwidth(summary['aggregate_bps']),
+              iperf.format_bandwidth(summary['min_bps']),
+              iperf.format_bandwidth(summary['mean_bps']),
+              iperf.format_bandwidth(summary['max_bps']),
+              summary['fairness'] or 0, summary['spread'] or 0))
+
 
+def test_vm2vm_sweep(request, pair, record_property):
+    """
+    Scaling sweep of the iperf3 parameters at each path of the pair
+    1. Create 4 VMs like in test_vm2vm, prepare iperf3 (the VMs are
+       shared with the other tests of the pair)
+    2. For each path (same node, different nodes, Floating IP, Router)
+       measure every value of 'sweep_parallel', 'sweep_window',
+       'sweep_tcp_length' and 'sweep_udp_length', one dimension at a time
+    3. Draw the throughput curves (and the packets per second of UDP)
+       and the knee of each curve
+    """
+    config = utils.get_configuration()
+    grid = sweep.get_grid(config)
+    if not grid:
+        pytest.skip("None of sweep_parallel, sweep_window, "
+                    "sweep_tcp_length, sweep_udp_length is set")
+    curves = {}
+    pair_topology = request.getfixturevalue('pair_topology')
     try:
-        zone1 = [service.zone for service in
-                 openstack_clients.compute.services.list() if
-                 service.host == pair[0]]
-        zone2 = [service.zone for service in
-                 openstack_clients.compute.services.list()
-                 if service.host == pair[1]]
-
-        # create 4 VMs
-        logger.info("Creating 4 VMs...")
-        vm1 = os_actions.create_basic_server(
-            os_resources['image_id'], os_resources['flavor_id'],
-            os_resources['net1'], '{0}:{1}'.format(zone1[0], pair[0]),
-            [os_resources['sec_group'].name], os_resources['keypair'].name)
-        logger.info("Created VM {}.".format(vm1.id))
-
-        vm2 = os_actions.create_basic_server(
-            os_resources['image_id'], os_resources['flavor_id'],
-            os_resources['net1'], '{0}:{1}'.format(zone1[0], pair[0]),
-            [os_resources['sec_group'].name], os_resources['keypair'].name)
-        logger.info("Created VM {}.".format(vm2.id))
-
-        vm3 = os_actions.create_basic_server(
-            os_resources['image_id'], os_resources['flavor_id'],
-            os_resources['net1'], '{0}:{1}'.format(zone2[0], pair[1]),
-            [os_resources['sec_group'].name], os_resources['keypair'].name)
-        logger.info("Created VM {}.".format(vm3.id))
-
-        vm4 = os_actions.create_basic_server(
-            os_resources['image_id'], os_resources['flavor_id'],
-            os_resources['net2'], '{0}:{1}'.format(zone2[0], pair[1]),
-            [os_resources['sec_group'].name], os_resources['keypair'].name)
-        logger.info("Created VM {}.".format(vm4.id))
-
-        vm_info = []
-        vms = []
-        vms.extend([vm1, vm2, vm3, vm4])
-        fips = []
-        time.sleep(5)
-
-        # Associate FIPs and check VMs are Active
-        logger.info("Creating Floating IPs and associating them...")
-        for i in range(4):
-            fip = openstack_clients.compute.floating_ips.create(
-                os_resources['ext_net']['name'])
-            fips.append(fip.id)
-            os_actions.check_vm_is_active(vms[i].id, timeout=timeout)
-            vms[i].add_floating_ip(fip)
-            private_address = vms[i].addresses[
-                list(vms[i].addresses.keys())[0]][0]['addr']
-            vm_info.append({'vm': vms[i], 'fip': fip.ip,
-                            'private_address': private_address})
-        # Check VMs are reachable and prepare iperf3
-        transport1 = ssh.SSHTransport(vm_info[0]['fip'], 'ubuntu',
-                                      password='dd', private_key=private_key)
-        logger.info("Checking VMs are reachable via SSH...")
-        for i in range(4):
-            if transport1.check_vm_is_reachable_ssh(
-                    floating_ip=vm_info[i]['fip'], timeout=ssh_timeout):
-                ssh.prepare_iperf(vm_info[i]['fip'], private_key=private_key)
-
-        # Prepare the result table and run iperf3
-        table_rows = []
-        table_rows.append(['Test Case', 'Host 1', 'Host 2', 'Result'])
-        # Do iperf3 measurement #1
-        logger.info("Doing 'VM to VM in same tenant on same node via Private "
-                    "IP, 1 thread' measurement...")
-        result1 = transport1.exec_command(
-            'iperf3 -c {} -t {} | grep sender | tail -n 1'.format(
-                vm_info[1]['private_address'], iperf_time))
-        res1 = (b" ".join(result1.split()[-4:-2:])).decode('utf-8')
-        logger.info("Result #1 is {}".format(res1))
-        table_rows.append(['VM to VM in same tenant on same node via '
-                           'Private IP, 1 thread',
-                           "{}".format(pair[0]),
-                           "{}".format(pair[0]),
-                           "{}".format(res1)])
-
-        # Do iperf3 measurement #2
-        logger.info("Doing 'VM to VM in same tenant on different HW nodes "
-                    "via Private IP, 1 thread' measurement...")
-        result2 = transport1.exec_command(
-            'iperf3 -c {} -t {} | grep sender | tail -n 1'.format(
-                vm_info[2]['private_address'], iperf_time))
-        res2 = (b" ".join(result2.split()[-4:-2:])).decode('utf-8')
-        logger.info("Result #2 is {}".format(res2))
-        table_rows.append(['VM to VM in same tenant on different HW nodes '
-                           'via Private IP, 1 thread',
-                           "{}".format(pair[0]),
-                           "{}".format(pair[1]),
-                           "{}".format(res2)])
-
-        # Do iperf3 measurement #3
-        logger.info("Doing 'VM to VM in same tenant on different HW nodes "
-                    "via Private IP, 10 threads' measurement...")
-        result3 = transport1.exec_command(
-            'iperf3 -c {} -P 10 -t {} | grep sender | tail -n 1'.format(
-                vm_info[2]['private_address'], iperf_time))
-        res3 = (b" ".join(result3.split()[-4:-2:])).decode('utf-8')
-        logger.info("Result #3 is {}".format(res3))
-        table_rows.append(['VM to VM in same tenant on different HW nodes '
-                           'via Private IP, 10 threads',
-                           "{}".format(pair[0]),
-                           "{}".format(pair[1]),
-                           "{}".format(res3)])
-
-        # Do iperf3 measurement #4
-        logger.info("Doing 'VM to VM in same tenant via Floating IP and VMs "
-                    "are on different nodes, 1 thread' measurement...")
-        result4 = transport1.exec_command(
-            'iperf3 -c {} -t {} | grep sender | tail -n 1'.format(
-                vm_info[2]['fip'], iperf_time))
-        res4 = (b" ".join(result4.split()[-4:-2:])).decode('utf-8')
-        logger.info("Result #4 is {}".format(res4))
-        table_rows.append(['VM to VM in same tenant via Floating IP and VMs '
-                           'are on different nodes, 1 thread',
-                           "{}".format(pair[0]),
-                           "{}".format(pair[1]),
-                           "{}".format(res4)])
-
-        # Do iperf3 measurement #5
-        logger.info("Doing 'VM to VM in same tenant, different HW nodes and "
-                    "each VM is connected to separate network which are "
-                    " connected using Router via Private IP, 1 thread' "
-                    "measurement...")
-        result5 = transport1.exec_command(
-            'iperf3 -c {} -t {} | grep sender | tail -n 1'.format(
-                vm_info[3]['private_address'], iperf_time))
-        res5 = (b" ".join(result5.split()[-4:-2:])).decode('utf-8')
-        logger.info("Result #5 is {}".format(res5))
-        table_rows.append(['VM to VM in same tenant, different HW nodes and '
-                           'each VM is connected to separate network which are'
-                           ' connected using Router via Private IP, 1 thread',
-                           "{}".format(pair[0]),
-                           "{}".format(pair[1]),
-                           "{}".format(res5)])
-
-        logger.info("Drawing the table with iperf results...")
-        result_table.add_rows(table_rows)
-        print((result_table.draw()))
-
-        print("Removing VMs and FIPs...")
-        logger.info("Removing VMs and FIPs...")
-        for vm in vms:
-            openstack_clients.compute.servers.delete(vm)
-        print("Removing FIPs...")
-        for fip in fips:
-            openstack_clients.compute.floating_ips.delete(fip)
+        transport1 = pair_topology.transport(0)
+        for path, index, address_key in pair_topology.PATHS:
+            logger.info("Sweeping '{}'...".format(path))
+            curves[path] = sweep.run_sweep(
+                transport1, pair_topology.vm_info[index][address_key], grid,
+                iperf_time=config.sweep_time,
+                udp_bandwidth=config.sweep_udp_bandwidth)
+    except Exception as e:
+        print(e)
+        pytest.fail("Something went wrong")
+
+    table_rows = [['Path', 'Parameter', 'Value', 'Result', 'pps', 'Knee']]
+    for path, path_curves in curves.items():
+        knees = sweep.get_knees(path_curves, min_gain=config.sweep_min_gain)
+        for dimension, points in path_curves.items():
+            for point in points:
+                table_rows.append([
+                    path, dimension, point.value,
+                    iperf.format_bandwidth(point.bits_per_second),
+                    "{:.0f}".format(point.pps) if point.pps else '-',
+                    '<' if point.value == knees[dimension] else ''])
+                record_property("{} {}<>{} {}={}".format(
+                    path, pair[0], pair[1], dimension, point.value),
+                    point.bits_per_second)
+            record_property("{} {}<>{} {} knee".format(
+                path, pair[0], pair[1], dimension), knees[dimension])
+    result_table = Texttable()
+    result_table.add_rows(table_rows)
+    print(result_table.draw())
+
+
+def test_vm2vm_udp(request, pair, record_property):
+    """
+    UDP jitter, packet loss and packets per second at each path of the pair
+    1. Create 4 VMs like in test_vm2vm, prepare iperf3 (the VMs are
+       shared with the other tests of the pair)
+    2. For each path (same node, different nodes, Floating IP, Router)
+       and each datagram size from 'udp_lengths':
+       - send UDP at 'udp_rate' and/or
+       - search for the highest rate with the loss within
+         'udp_loss_percent', up to 'udp_search_max_rate'
+    3. Draw the table with the rate, received packets per second, jitter
+       and loss
+    """
+    config = utils.get_configuration()
+    if not config.udp_rate and not config.udp_search_max_rate:
+        pytest.skip("Neither udp_rate nor udp_search_max_rate is set")
+    results = []
+    pair_topology = request.getfixturevalue('pair_topology')
+    try:
+        transport1 = pair_topology.transport(0)
+        for path, index, address_key in pair_topology.PATHS:
+            server = pair_topology.vm_info[index][address_key]
+            for length in config.udp_lengths:
+                if config.udp_rate:
+                    logger.info("UDP '{}', {} bytes at {}...".format(
+                        path, length, config.udp_rate))
+                    results.append((path, length, config.udp_rate,
+                                    iperf.run_udp(transport1, server,
+                                                  config.udp_rate, length,
+                                                  config.udp_time)))
+                if config.udp_search_max_rate:
+                    logger.info("UDP '{}', {} bytes, searching for the "
+                                "max rate...".format(path, length))
+                    _, result = iperf.search_udp_rate(
+                        transport1, server, length,
+                        iperf.parse_rate(config.udp_search_max_rate),
+                        iperf_time=config.udp_time,
+                        loss_percent=config.udp_loss_percent)
+                    results.append((path, length, 'max', result))
+    except Exception as e:
+        print(e)
+        pytest.fail("Something went wrong")
+
+    table_rows = [['Path', 'Datagram, bytes', 'Target rate', 'Result',
+                   'Received pps', 'Jitter, ms', 'Loss, %']]
+    for path, length, target, result in results:
+        name = "{} {}<>{} UDP {} bytes {}".format(path, pair[0], pair[1],
+                                                   length, target)
+        if result is None:
+            table_rows.append([path, length, target,
+                               "loss even at the lowest rate", None, None,
+                               None])
+            record_property(name, None)
+            continue
+        pps = iperf.get_received_pps(result)
+        table_rows.append([path, length, target,
+                           iperf.format_bandwidth(result.bits_per_second),
+                           "{:.0f}".format(pps) if pps else None,
+                           result.jitter_ms, result.lost_percent])
+        record_property(name, result.bits_per_second)
+        record_property(name + " pps", pps)
+        record_property(name + " jitter ms", result.jitter_ms)
+        record_property(name + " loss %", result.lost_percent)
+    result_table = Texttable()
+    result_table.add_rows(table_rows)
+    print(result_table.draw())
+
+
+def test_vm2vm_latency(request, pair, record_property):
+    """
+    Round-trip latency at each path of the pair
+    1. Create 4 VMs like in test_vm2vm (the VMs are shared with the
+       other tests of the pair), start TCP echo servers
+    2. For each path (same node, different nodes, Floating IP, Router)
+       collect 'latency_samples' ICMP echo and TCP request/response
+       round trips from vm1
+    3. Draw the table with p50/p90/p99/p99.9 and max latency
+    """
+    config = utils.get_configuration()
+    if not config.latency_samples:
+        pytest.skip("latency_samples is not set")
+    results = []
+    pair_topology = request.getfixturevalue('pair_topology')
+    try:
+        transport1 = pair_topology.transport(0)
+        for index in set(index for _, index, _ in pair_topology.PATHS):
+            latency.start_echo_server(pair_topology.transport(index))
+        for path, index, address_key in pair_topology.PATHS:
+            server = pair_topology.vm_info[index][address_key]
+            logger.info("Measuring ICMP latency '{}'...".format(path))
+            results.append((path, 'ICMP', latency.measure_icmp(
+                transport1, server, count=config.latency_samples,
+                interval=config.latency_ping_interval)))
+            logger.info("Measuring TCP RR latency '{}'...".format(path))
+            results.append((path, 'TCP RR', latency.measure_tcp_rr(
+                transport1, server, count=config.latency_samples,
+                interval=config.latency_rr_interval)))
     except Exception as e:
         print(e)
-        print("Something went wrong")
-        if 'vms' in locals():
-            logger.info("Removing VMs...")
-            for vm in vms:
-                openstack_clients.compute.servers.delete(vm)
-            if 'fips' in locals():
-                logger.info("Removing FIPs...")
-                for fip in fips:
-                    openstack_clients.compute.floating_ips.delete(fip)
-        else:
-            print("Skipping cleaning, VMs were not created")
         pytest.fail("Something went wrong")
+
+    keys = ['p50', 'p90', 'p99', 'p99.9', 'max']
+    table_rows = [['Path', 'Protocol', 'Samples'] +
+                  ["{}, ms".format(key) for key in keys]]
+    for path, protocol, histogram in results:
+        summary = histogram.summary()
+        table_rows.append([path, protocol, summary['samples']] +
+                          ["{:.3f}".format(summary[key]) for key in keys])
+        for key in keys:
+            record_property("{} {}<>{} {} {} ms".format(
+                path, pair[0], pair[1], protocol, key), summary[key])
+    result_table = Texttable()
+    result_table.add_rows(table_rows)
+    print(result_table.draw())
@@ -0,0 +1,92 @@
+import logging
+
+import pytest
+from texttable import Texttable
+
+import utils
+from utils import topology
+from utils import volume
+
+
+logger = logging.getLogger(__name__)
+
+
+def test_volume_fio(openstack_clients, os_resources, record_property):
+    """
+    Block storage test: fio at the Cinder volumes attached to the VMs
+    1. Create a VM at each of 'volume_hosts' compute hosts
+    2. Create a volume of 'volume_size' GB for each VM and attach the
+       volumes to the VMs at the same time
+    3. Fill the volumes with a sequential write ('fio_precondition'),
+       so the reads are not served from the unallocated blocks
+    4. Run each fio job (each of 'fio_rw' with each of 'fio_block_sizes'
+       and 'fio_iodepths') at all the volumes at once
+    5. Detach and delete the volumes, delete the VMs
+    6. Draw the table with IOPS, bandwidth and completion latency of each
+       job at each host, and the totals of each job
+    """
+    config = utils.get_configuration()
+    if not config.volume_size:
+        pytest.skip("volume_size is not set")
+    hosts = utils.get_hosts()
+    if config.volume_hosts:
+        hosts = hosts[:config.volume_hosts]
+    jobs = volume.get_jobs(config)
+    vms = topology.FabricTopology(openstack_clients, hosts, os_resources)
+    volumes = volume.VolumeSet(openstack_clients, config.volume_size,
+                               volume_type=config.volume_type,
+                               max_workers=config.vm_prepare_workers)
+    try:
+        vms.create(nova_timeout=config.nova_timeout,
+                   ssh_timeout=config.ssh_timeout,
+                   vm_prepare_workers=config.vm_prepare_workers,
+                   prepare_iperf=False)
+        volume.prepare_fio([info['fip'] for info in vms.vm_info],
+                           os_resources['keypair'].private_key,
+                           max_workers=config.vm_prepare_workers)
+        created = volumes.create([info['vm'] for info in vms.vm_info],
+                                 timeout=config.nova_timeout)
+        transports = [vms.transport(index)
+                      for index in range(len(vms.vm_info))]
+        devices = [volume.get_device(transport, created_volume.id)
+                   for transport, created_volume in zip(transports, created)]
+        if config.fio_precondition:
+            volume.precondition(transports, devices)
+        logger.info("Running {} fio jobs at {} volumes...".format(
+            len(jobs), len(devices)))
+        results = volume.run_jobs(transports, devices, jobs,
+                                  runtime=config.fio_runtime)
+    except Exception as e:
+        print(e)
+        pytest.fail("Something went wrong")
+    finally:
+        try:
+            volumes.delete(timeout=config.nova_timeout)
+        finally:
+            vms.delete(timeout=config.nova_timeout)
+
+    percentiles = ['p' + percent for percent in volume.PERCENTILES]
+    table_rows = [['Host', 'Job', 'IOPS', 'Bandwidth'] +
+                  ["clat {}, ms".format(name) for name in percentiles]]
+    for (rw, block_size, iodepth), job_results in zip(jobs, results):
+        job = "{} bs={} iodepth={}".format(rw, block_size, iodepth)
+        for index, result in enumerate(job_results):
+            table_rows.append(
+                [vms.host(index), job, "{:.0f}".format(result.iops),
+                 volume.format_bytes(result.bytes_per_second)] +
+                ["{:.3f}".format(result.clat_ms[name])
+                 if result.clat_ms[name] is not None else "-"
+                 for name in percentiles])
+            record_property("{} {} IOPS".format(vms.host(index), job),
+                            result.iops)
+        total_iops = sum(result.iops for result in job_results)
+        total_bytes = sum(result.bytes_per_second for result in job_results)
+        table_rows.append(['Total', job, "{:.0f}".format(total_iops),
+                           volume.format_bytes(total_bytes)] +
+                          ["-"] * len(percentiles))
+        record_property("{} total IOPS".format(job), total_iops)
+        record_property("{} total bytes per second".format(job),
+                        total_bytes)
+    result_table = Texttable()
+    result_table.add_rows(table_rows)
+    print(result_table.draw())
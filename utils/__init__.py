@@ -1,8 +1,10 @@
+import json
 import os
-import yaml
 import logging
+import time
 
 from utils import os_client
+from utils.config import get_configuration  # noqa
 
 logger = logging.getLogger(__name__)
 
@@ -17,31 +19,59 @@ def compile_pairs(nodes):
     return result
 
 
+def compile_rounds(nodes, full_mesh=False):
+    """Split the hosts into rounds of pairs, the pairs of one round do not
+    share hosts and can be tested at the same time.
+    Without full_mesh there is one round with compile_pairs pairs. With
+    full_mesh each host is paired with each other host, and the pairs are
+    spread across the rounds with the circle method.
+    """
+    if not full_mesh:
+        return [compile_pairs(list(nodes))]
+    hosts = list(nodes)
+    if len(hosts) % 2 != 0:
+        # the host paired with None rests in the round
+        hosts.append(None)
+    rounds = []
+    for _ in range(len(hosts) - 1):
+        result = {}
+        for i in range(len(hosts) // 2):
+            pair = (hosts[i], hosts[-1 - i])
+            if None not in pair:
+                result[pair[0] + '<>' + pair[1]] = pair
+        rounds.append(result)
+        # keep the first host, rotate the others
+        hosts = [hosts[0], hosts[-1]] + hosts[1:-1]
+    return rounds
+
+
+def get_rounds():
+    rounds = compile_rounds(get_hosts(),
+                            full_mesh=get_configuration().full_mesh)
+    return {'round-{}'.format(i + 1): pairs
+            for i, pairs in enumerate(rounds)}
+
+
 def get_pairs():
+    return compile_pairs(get_hosts())
+
+
+def get_hosts():
     config = get_configuration()
-    cmp_hosts = config.get('CMP_HOSTS') or []
-    skipped_nodes = config.get('skipped_nodes') or []
+    cmp_hosts = list(config.CMP_HOSTS)
+    skipped_nodes = config.skipped_nodes
     if skipped_nodes:
         print(("\nNotice: {} nodes will be skipped for vm2vm test".format(
             ",".join(skipped_nodes))))
         logger.info("Skipping nodes {}".format(",".join(skipped_nodes)))
     if not cmp_hosts:
-        openstack_clients = os_client.OfficialClientManager(
-            username=os.environ['OS_USERNAME'],
-            password=os.environ['OS_PASSWORD'],
-            tenant_name=os.environ['OS_PROJECT_NAME'],
-            auth_url=os.environ['OS_AUTH_URL'],
-            cert=False,
-            domain=os.environ['OS_PROJECT_DOMAIN_NAME']
-        )
-        os_actions = os_client.OSCliActions(openstack_clients)
-        nova_computes = os_actions.list_nova_computes()
+        nova_computes = get_nova_computes()
         if len(nova_computes) < 2:
             raise BaseException(
                 "At least 2 compute hosts are needed for VM2VM test, "
                 "now: {}.".format(len(nova_computes)))
-        cmp_hosts = [n.host_name for n in nova_computes
-                     if n.host_name not in skipped_nodes]
+        cmp_hosts = [host for host in nova_computes
+                     if host not in skipped_nodes]
         if len(cmp_hosts) < 2:
             raise BaseException(
                 "At least 2 compute hosts are needed for VM2VM test. "
@@ -50,24 +80,57 @@ def get_pairs():
         logger.info("CMP_HOSTS option is not set, using host pair from "
                     "Nova compute list. Pair generated: {}".format(cmp_hosts))
 
-    return compile_pairs(cmp_hosts)
+    return cmp_hosts
 
 
-def get_configuration():
-    """function returns configuration for environment
-    and for test if it's specified"""
+# the compute host names listed in this process, by the cloud
+_computes = {}
 
-    global_config_file = os.path.join(
-        os.path.dirname(os.path.abspath(__file__)), "../global_config.yaml")
-    with open(global_config_file, 'r') as file:
-        global_config = yaml.load(file, Loader=yaml.SafeLoader)
-    for param in list(global_config.keys()):
-        if param in list(os.environ.keys()):
-            if ',' in os.environ[param]:
-                global_config[param] = []
-                for item in os.environ[param].split(','):
-                    global_config[param].append(item)
-            else:
-                global_config[param] = os.environ[param]
 
-    return global_config
+def get_nova_computes():
+    """Host names of the Nova computes.
+    The list is requested once per process. With hosts_cache_path set it
+    is also kept in that file and reused by the next runs for
+    hosts_cache_ttl seconds.
+    """
+    config = get_configuration()
+    cloud = "{}|{}".format(os.environ['OS_AUTH_URL'],
+                           os.environ['OS_PROJECT_NAME'])
+    if cloud in _computes:
+        return list(_computes[cloud])
+    cache_path = os.path.expanduser(config.hosts_cache_path)
+    cache = {}
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as cache_file:
+                cache = json.load(cache_file)
+        except ValueError as e:
+            logger.warning("Ignoring the broken hosts cache {}: {}".format(
+                cache_path, e))
+        cached = cache.get(cloud)
+        if cached and time.time() - cached['timestamp'] < \
+                config.hosts_cache_ttl:
+            logger.info("Using the Nova compute list cached at {}".format(
+                cache_path))
+            _computes[cloud] = cached['hosts']
+            return list(cached['hosts'])
+
+    openstack_clients = os_client.OfficialClientManager(
+        username=os.environ['OS_USERNAME'],
+        password=os.environ['OS_PASSWORD'],
+        tenant_name=os.environ['OS_PROJECT_NAME'],
+        auth_url=os.environ['OS_AUTH_URL'],
+        cert=False,
+        domain=os.environ['OS_PROJECT_DOMAIN_NAME']
+    )
+    os_actions = os_client.OSCliActions(openstack_clients)
+    hosts = [n.host_name for n in os_actions.list_nova_computes()]
+    _computes[cloud] = hosts
+    if cache_path:
+        cache[cloud] = {'timestamp': time.time(), 'hosts': hosts}
+        cache_dir = os.path.dirname(cache_path)
+        if cache_dir and not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_path, 'w') as cache_file:
+            json.dump(cache, cache_file)
+    return list(hosts)
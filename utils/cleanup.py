@@ -0,0 +1,213 @@
+"""Sweeper of the resources left behind by the interrupted test runs.
+
+The resources are found by the name prefixes used by the tests and by
+their age, so the resources of the runs still in progress are kept.
+The persistent spt-persistent-* resources are not touched, see
+utils.persistent.
+
+    python -m utils.cleanup [--dry-run] [--max-age HOURS]
+"""
+import argparse
+import datetime
+import logging
+import os
+import sys
+
+from utils import graph
+from utils import os_client
+from utils import volume
+
+logger = logging.getLogger(__name__)
+
+SERVER_PREFIX = 'spt-test-server-'
+NETWORK_PREFIXES = ('spt-test-net-', 'spt-ext-net-')
+ROUTER_PREFIX = 'spt-test-router-'
+SECGROUP_PREFIX = 'spt-test-secgroup-'
+KEYPAIR_PREFIX = 'spt-key-'
+VOLUME_PREFIX = volume.PREFIX
+
+
+def get_age(created_at, now=None):
+    """Age in seconds of the ISO 8601 UTC creation time like
+    '2020-02-10T13:31:23Z', None if unknown."""
+    if not created_at:
+        return None
+    created_at = created_at.rstrip('Z').split('.')[0]
+    try:
+        created = datetime.datetime.strptime(created_at, '%Y-%m-%dT%H:%M:%S')
+    except ValueError:
+        return None
+    now = now or datetime.datetime.utcnow()
+    return (now - created).total_seconds()
+
+
+def is_orphan(name, created_at, prefixes, max_age):
+    """The resource is an orphan if it has the test name prefix and is
+    older than max_age seconds. The resources of unknown age are orphans
+    only with max_age 0."""
+    if not name or not name.startswith(prefixes):
+        return False
+    age = get_age(created_at)
+    return max_age == 0 or (age is not None and age >= max_age)
+
+
+def find_orphans(os_clients, max_age=0):
+    """Find the test resources older than max_age seconds.
+    :return: dict of the kind: list of the resources, the servers, key
+    pairs and volumes are the client objects, the other ones are Neutron
+    dicts
+    """
+    compute = os_clients.compute
+    network = os_clients.network
+    keypairs = []
+    for keypair in compute.keypairs.list():
+        if keypair.name.startswith(KEYPAIR_PREFIX):
+            # the list does not have the creation time
+            keypair = compute.keypairs.get(keypair.name)
+            if is_orphan(keypair.name, getattr(keypair, 'created_at', None),
+                         KEYPAIR_PREFIX, max_age):
+                keypairs.append(keypair)
+    return {
+        'servers': [
+            server for server in compute.servers.list(
+                search_opts={'name': SERVER_PREFIX})
+            if is_orphan(server.name, server.created, SERVER_PREFIX,
+                         max_age)],
+        'routers': [
+            router for router in network.list_routers()['routers']
+            if is_orphan(router['name'], router.get('created_at'),
+                         ROUTER_PREFIX, max_age)],
+        'networks': [
+            net for net in network.list_networks()['networks']
+            if is_orphan(net['name'], net.get('created_at'),
+                         NETWORK_PREFIXES, max_age)],
+        'security_groups': [
+            secgroup for secgroup in
+            network.list_security_groups()['security_groups']
+            if is_orphan(secgroup['name'], secgroup.get('created_at'),
+                         SECGROUP_PREFIX, max_age)],
+        'keypairs': keypairs,
+        'volumes': [
+            item for item in os_clients.volume.volumes.list()
+            if is_orphan(item.name, item.created_at, VOLUME_PREFIX,
+                         max_age)],
+    }
+
+
+def delete_orphans(os_actions, orphans, timeout=300, max_workers=8):
+    """Delete the resources concurrently in the dependency order: the VMs
+    (with their floating IPs) first, then the routers, the networks once
+    their ports are gone, the security groups and the volumes.
+    :raises graph.GraphError: if some resources could not be deleted
+    """
+    network = os_actions.os_clients.network
+    compute = os_actions.os_clients.compute
+    tasks = {}
+    if orphans['servers']:
+        tasks['servers'] = (lambda r: os_actions.delete_servers(
+            orphans['servers'], timeout=timeout, name_filter=SERVER_PREFIX),
+            [])
+    server_deps = list(tasks)
+
+    def delete_router(router):
+        def delete(_):
+            for port in network.list_ports(
+                    device_id=router['id'],
+                    device_owner='network:router_interface')['ports']:
+                network.remove_interface_router(router['id'],
+                                                {'port_id': port['id']})
+            if router.get('external_gateway_info'):
+                network.remove_gateway_router(router['id'])
+            os_actions.wait_for_ports_deleted(
+                timeout=timeout, device_id=router['id'],
+                ignored_owners=('network:router_ha_interface',))
+            network.delete_router(router['id'])
+        return delete
+
+    router_deps = list(server_deps)
+    for router in orphans['routers']:
+        name = 'router:' + router['id']
+        tasks[name] = (delete_router(router), server_deps)
+        router_deps.append(name)
+
+    def delete_network(net):
+        def delete(_):
+            os_actions.wait_for_ports_deleted(timeout=timeout,
+                                              network_id=net['id'])
+            network.delete_network(net['id'])
+        return delete
+
+    for net in orphans['networks']:
+        tasks['network:' + net['id']] = (delete_network(net), router_deps)
+    for secgroup in orphans['security_groups']:
+        tasks['security_group:' + secgroup['id']] = (
+            lambda r, secgroup_id=secgroup['id']:
+            network.delete_security_group(secgroup_id), server_deps)
+    for keypair in orphans['keypairs']:
+        tasks['keypair:' + keypair.name] = (
+            lambda r, name=keypair.name: compute.keypairs.delete(name), [])
+
+    def delete_volume(orphan):
+        def delete(_):
+            volume_client = os_actions.os_clients.volume
+            # the volumes of the deleted servers are detached in the
+            # background, they can be deleted once available
+            if not orphan.status.lower().startswith('error'):
+                volume.wait_for_volumes(volume_client, [orphan.id],
+                                        'available', timeout=timeout)
+            volume_client.volumes.delete(orphan.id)
+        return delete
+
+    for orphan in orphans['volumes']:
+        tasks['volume:' + orphan.id] = (delete_volume(orphan), server_deps)
+    graph.run_graph(tasks, max_workers=max_workers)
+
+
+def describe(resource):
+    if isinstance(resource, dict):
+        return "{} ({})".format(resource['name'], resource['id'])
+    return "{} ({})".format(resource.name, getattr(resource, 'id', ''))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        prog='python -m utils.cleanup',
+        description="Delete the spt-* resources left by the interrupted "
+                    "test runs.")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only list the resources to delete")
+    parser.add_argument('--max-age', type=float, default=6,
+                        help="delete only the resources older than this, "
+                             "hours; 0 deletes all of them (default: 6)")
+    parser.add_argument('--timeout', type=int, default=300,
+                        help="timeout of each deletion, seconds")
+    args = parser.parse_args(argv[1:])
+    logging.basicConfig(level=logging.INFO)
+    openstack_clients = os_client.OfficialClientManager(
+        username=os.environ['OS_USERNAME'],
+        password=os.environ['OS_PASSWORD'],
+        tenant_name=os.environ['OS_PROJECT_NAME'],
+        auth_url=os.environ['OS_AUTH_URL'],
+        cert=False,
+        domain=os.environ['OS_PROJECT_DOMAIN_NAME']
+    )
+    orphans = find_orphans(openstack_clients, max_age=args.max_age * 3600)
+    for kind, resources in sorted(orphans.items()):
+        for resource in resources:
+            print("{}: {}".format(kind, describe(resource)))
+    if not any(orphans.values()):
+        print("No orphaned resources found.")
+        return 0
+    if args.dry_run:
+        return 0
+    try:
+        delete_orphans(os_client.OSCliActions(openstack_clients), orphans,
+                       timeout=args.timeout)
+    except graph.GraphError as e:
+        logger.error(str(e))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
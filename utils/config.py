@@ -0,0 +1,205 @@
+import copy
+import logging
+import os
+import threading
+
+import yaml
+
+logger = logging.getLogger(__name__)
+
+CONFIG_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "../global_config.yaml")
+
+
+class ConfigurationError(ValueError):
+    pass
+
+
+def to_bool(value):
+    if isinstance(value, bool):
+        return value
+    if str(value).strip().lower() in ('true', 'yes', '1'):
+        return True
+    if str(value).strip().lower() in ('false', 'no', '0', ''):
+        return False
+    raise ValueError("'{}' is not a boolean".format(value))
+
+
+def to_list(value):
+    """Host lists and similar: YAML list or comma separated string."""
+    if value is None:
+        return []
+    if not isinstance(value, list):
+        value = str(value).split(',')
+    return [str(item).strip() for item in value if str(item).strip()]
+
+
+def to_int_list(value):
+    return [int(item) for item in to_list(value)]
+
+
+def to_str(value):
+    return '' if value is None else str(value)
+
+
+def choice_list(*options):
+    def to_choice_list(value):
+        values = to_list(value)
+        unknown = [item for item in values if item not in options]
+        if unknown:
+            raise ValueError("{} are not in {}".format(
+                ", ".join(unknown), ", ".join(options)))
+        return values
+    return to_choice_list
+
+
+def choice(*options):
+    def to_choice(value):
+        if value not in options:
+            raise ValueError("'{}' is not one of {}".format(
+                value, ", ".join(options)))
+        return value
+    return to_choice
+
+
+# name: (type, default)
+FIELDS = {
+    'http_pool_maxsize': (int, 32),
+
+    'IMAGE_SIZE_MB': (int, 2000),
+    'IMAGE_STREAMING': (to_bool, False),
+    'IMAGE_VERIFY_CHECKSUM': (to_bool, False),
+    'GLANCE_REPORT_PATH': (to_str, ''),
+    'GLANCE_CONCURRENCY': (to_int_list, []),
+    'GLANCE_CONCURRENT_IMAGE_SIZE_MB': (int, 500),
+
+    'CMP_HOSTS': (to_list, []),
+    'image_name': (to_str, 'Ubuntu-18.04'),
+    'flavor_name': (to_str, 'spt-test'),
+    'flavor_ram': (int, 1536),
+    'flavor_vcpus': (int, 1),
+    'flavor_disk': (int, 5),
+    'nova_timeout': (int, 300),
+    'external_network': (to_str, 'public'),
+    'iperf_prep_string': (to_str, ''),
+    'internet_at_vms': (to_bool, True),
+    'iperf_deb_package_dir_path': (to_str, '/artifacts/mos-spt/'),
+    'iperf_deb_relay': (to_bool, False),
+    'iperf_image_prebuilt': (to_bool, False),
+    'iperf_time': (int, 60),
+    'iperf_adaptive': (to_bool, False),
+    'iperf_min_time': (int, 10),
+    'iperf_ci_percent': (float, 5.0),
+    'iperf_directions': (choice_list('forward', 'reverse', 'bidir'),
+                         ['forward', 'reverse', 'bidir']),
+    'sweep_parallel': (to_int_list, []),
+    'sweep_window': (to_list, []),
+    'sweep_tcp_length': (to_list, []),
+    'sweep_udp_length': (to_int_list, []),
+    'sweep_udp_bandwidth': (to_str, '1G'),
+    'sweep_time': (int, 10),
+    'sweep_min_gain': (float, 0.1),
+    'udp_lengths': (to_int_list, [64, 1400]),
+    'udp_rate': (to_str, ''),
+    'udp_search_max_rate': (to_str, ''),
+    'udp_loss_percent': (float, 0.0),
+    'udp_time': (int, 10),
+    'latency_samples': (int, 0),
+    'latency_ping_interval': (float, 0.2),
+    'latency_rr_interval': (float, 0.01),
+    'ssh_timeout': (int, 500),
+    'vm_prepare_workers': (int, 8),
+    'skipped_nodes': (to_list, []),
+    'hosts_cache_path': (to_str, ''),
+    'hosts_cache_ttl': (int, 3600),
+    'pair_scheduler': (choice('serial', 'rounds'), 'serial'),
+    'full_mesh': (to_bool, False),
+    'pairs_concurrency': (int, 4),
+    'saturation_hosts': (int, 0),
+    'saturation_vms_per_host': (int, 0),
+    'saturation_options': (to_str, ''),
+    'volume_size': (int, 0),
+    'volume_type': (to_str, ''),
+    'volume_hosts': (int, 0),
+    'fio_rw': (choice_list('read', 'write', 'randread', 'randwrite'),
+               ['read', 'write', 'randread', 'randwrite']),
+    'fio_block_sizes': (to_list, ['4k', '1M']),
+    'fio_iodepths': (to_int_list, [1, 32]),
+    'fio_runtime': (int, 30),
+    'fio_precondition': (to_bool, True),
+    'fio_deb_package_dir_path': (to_str, ''),
+    'persistent_resources': (to_bool, False),
+    'persistent_state_dir': (to_str, '~/.mos-spt'),
+}
+
+
+class Configuration(dict):
+    """Configuration values with attribute access: config.iperf_time"""
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError("No '{}' configuration option".format(name))
+
+
+def load(path=CONFIG_FILE, environ=None):
+    """Read the YAML file, override the values with the environment
+    variables of the same name and convert the known options to their
+    types.
+    :raises ConfigurationError: with all the invalid options
+    """
+    environ = os.environ if environ is None else environ
+    with open(path, 'r') as file:
+        raw = yaml.load(file, Loader=yaml.SafeLoader) or {}
+    for param in set(raw) | set(FIELDS):
+        if param in environ:
+            raw[param] = environ[param]
+
+    config = Configuration()
+    errors = []
+    for param, value in raw.items():
+        if param in FIELDS:
+            continue
+        # not typed options keep the old behaviour: a comma separated
+        # environment variable becomes a list
+        if param in environ and ',' in value:
+            value = value.split(',')
+        config[param] = value
+    for param, (to_type, default) in FIELDS.items():
+        value = raw.get(param)
+        if value is None:
+            config[param] = copy.copy(default)
+            continue
+        try:
+            config[param] = to_type(value)
+        except (TypeError, ValueError) as e:
+            errors.append("{}={!r}: {}".format(param, value, e))
+    if errors:
+        raise ConfigurationError(
+            "Invalid options in {} or environment: {}".format(
+                path, "; ".join(errors)))
+    return config
+
+
+_lock = threading.Lock()
+_cache = {'config': None, 'mtime': None}
+
+
+def get_configuration(reload=False):
+    """Return the configuration, it is loaded once and reloaded only if
+    the file is modified or reload is True."""
+    mtime = os.path.getmtime(CONFIG_FILE)
+    with _lock:
+        if reload or _cache['config'] is None or _cache['mtime'] != mtime:
+            _cache['config'] = load()
+            _cache['mtime'] = mtime
+            logger.debug("Loaded configuration from {}".format(CONFIG_FILE))
+        return _cache['config']
+
+
+def invalidate():
+    """Forget the loaded configuration, e.g. after the environment is
+    changed."""
+    with _lock:
+        _cache['config'] = None
@@ -0,0 +1,210 @@
+from collections import namedtuple
+from concurrent import futures
+import hashlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ImageDataStream(object):
+    """File-like source of the image data generated on the fly.
+
+    One random block is generated and repeated until the size is reached,
+    so nothing is kept on the local disk and the memory usage does not
+    depend on the image size. The md5 of the data is calculated while
+    it is read if checksum is True.
+    """
+
+    def __init__(self, size, checksum=False, block_size=CHUNK_SIZE):
+        self.size = size
+        self.remaining = size
+        self.block = os.urandom(block_size)
+        self.md5 = hashlib.md5() if checksum else None
+
+    def __len__(self):
+        return self.size
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > len(self.block):
+            size = len(self.block)
+        size = min(size, self.remaining)
+        if not size:
+            return b''
+        self.remaining -= size
+        data = self.block[:size]
+        if self.md5 is not None:
+            self.md5.update(data)
+        return data
+
+    def __iter__(self):
+        return iter(lambda: self.read(CHUNK_SIZE), b'')
+
+    def hexdigest(self):
+        return self.md5.hexdigest() if self.md5 is not None else None
+
+
+def discard(chunks, checksum=False):
+    """Read the image data chunks without storing them.
+    :return: tuple of the received size in bytes and md5 hexdigest (or
+    None if checksum is False)
+    """
+    md5 = hashlib.md5() if checksum else None
+    size = 0
+    for chunk in chunks:
+        size += len(chunk)
+        if md5 is not None:
+            md5.update(chunk)
+    return size, md5.hexdigest() if md5 is not None else None
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of the values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(percent / 100.0 * len(ordered))), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class TransferTimeline(object):
+    """Arrival time and size of each chunk of one transfer.
+
+    For downloads a chunk is recorded when it is received. For uploads it
+    is recorded when the HTTP client reads the next chunk to send, that is
+    right after the previous one is sent. The first read of an upload
+    happens before anything reaches the server, so the uploads have no
+    time to first byte (with_ttfb=False).
+    """
+
+    def __init__(self, with_ttfb=True):
+        self.with_ttfb = with_ttfb
+        self.start = None
+        self.chunks = []
+
+    def begin(self):
+        self.start = time.time()
+
+    def record(self, size):
+        self.chunks.append((time.time(), size))
+
+    @property
+    def ttfb(self):
+        """Time to the first byte from the beginning, seconds."""
+        if not self.with_ttfb or not self.chunks:
+            return None
+        return self.chunks[0][0] - self.start
+
+    def chunk_latencies(self):
+        """Time between the consecutive chunks, seconds."""
+        timestamps = [ts for ts, _ in self.chunks]
+        return [b - a for a, b in zip(timestamps, timestamps[1:])]
+
+    def throughput(self, interval=1.0):
+        """MB/s at each interval since the beginning."""
+        buckets = []
+        for ts, size in self.chunks:
+            index = int((ts - self.start) / interval)
+            buckets.extend([0] * (index + 1 - len(buckets)))
+            buckets[index] += size
+        return [size / 1024.0 / 1024 / interval for size in buckets]
+
+    def summary(self):
+        latencies = self.chunk_latencies()
+        result = {
+            'chunks': len(self.chunks),
+            'bytes': sum(size for _, size in self.chunks),
+            'throughput_mbps': self.throughput(),
+        }
+        if self.with_ttfb:
+            result['ttfb_s'] = self.ttfb
+        for percent in (50, 90, 99, 100):
+            value = percentile(latencies, percent)
+            result['chunk_latency_p{}_ms'.format(percent)] = \
+                value * 1000 if value is not None else None
+        return result
+
+
+class TimedReader(object):
+    """File-like wrapper recording the reads into the timeline."""
+
+    def __init__(self, source, timeline):
+        self.source = source
+        self.timeline = timeline
+
+    def read(self, size=-1):
+        data = self.source.read(size)
+        if data:
+            self.timeline.record(len(data))
+        return data
+
+
+def timed_chunks(chunks, timeline):
+    """Yield the chunks recording them into the timeline."""
+    for chunk in chunks:
+        timeline.record(len(chunk))
+        yield chunk
+
+
+# one transfer: start and end timestamps, size in bytes
+Transfer = namedtuple('Transfer', ['start', 'end', 'size'])
+
+# result of the concurrent transfers of one direction
+ConcurrentRun = namedtuple('ConcurrentRun', [
+    'streams', 'direction', 'aggregate_mbps', 'per_stream_mbps'])
+
+
+def upload(image_client, image_id, size):
+    image_data = ImageDataStream(size)
+    start = time.time()
+    image_client.images.upload(image_id, image_data=image_data)
+    return Transfer(start, time.time(), size)
+
+
+def download(image_client, image_id):
+    start = time.time()
+    size, _ = discard(image_client.images.data(image_id, do_checksum=False))
+    return Transfer(start, time.time(), size)
+
+
+def run_concurrently(func, args_list):
+    """Call func(*args) for each args at the same moment in threads.
+    :return: list of the results in the order of args_list
+    """
+    barrier = threading.Barrier(len(args_list))
+
+    def run(args):
+        barrier.wait()
+        return func(*args)
+
+    with futures.ThreadPoolExecutor(max_workers=len(args_list)) as executor:
+        return list(executor.map(run, args_list))
+
+
+def summarize(streams, direction, transfers):
+    """Aggregate MB/s is the total size divided by the time from the
+    first start to the last end, per-stream MB/s is the mean of the
+    streams speeds."""
+    megabytes = [t.size / 1024.0 / 1024 for t in transfers]
+    wall_time = max(t.end for t in transfers) - \
+        min(t.start for t in transfers)
+    per_stream = [mb / (t.end - t.start)
+                  for mb, t in zip(megabytes, transfers)]
+    return ConcurrentRun(streams, direction, sum(megabytes) / wall_time,
+                         sum(per_stream) / len(per_stream))
+
+
+def scaling_limit(runs, min_gain=0.1):
+    """Find the stream count after which the aggregate throughput stops
+    scaling: the next step gives less than min_gain relative increase.
+    :param runs: ConcurrentRun list of one direction sorted by streams
+    :return: the stream count or None if it scales up to the last run
+    """
+    for prev, run in zip(runs, runs[1:]):
+        if run.aggregate_mbps < prev.aggregate_mbps * (1 + min_gain):
+            return prev.streams
+    return None
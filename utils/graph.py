@@ -0,0 +1,59 @@
+from concurrent import futures
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class GraphError(Exception):
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+        super(GraphError, self).__init__(
+            "Failed tasks: {}".format("; ".join(
+                "{}: {}".format(name, e) for name, e in errors.items())))
+
+
+def run_graph(tasks, max_workers=8):
+    """Run the tasks concurrently as soon as their dependencies are done.
+    :param tasks: dict of name: (func, [dependency names]), func is called
+    with the dict of the results of the finished tasks
+    :return: dict of name: result of the task
+    :raises GraphError: if some tasks failed, the tasks depending on them
+    are not run, the other ones are finished
+    """
+    for name, (_, deps) in tasks.items():
+        unknown = set(deps) - set(tasks)
+        if unknown:
+            raise ValueError("Task {} depends on unknown tasks {}".format(
+                name, ", ".join(sorted(unknown))))
+    results = {}
+    errors = {}
+    pending = dict(tasks)
+    running = {}
+    with futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while pending or running:
+            for name, (func, deps) in list(pending.items()):
+                if any(dep in errors for dep in deps):
+                    errors[name] = Exception("skipped, dependency failed")
+                    del pending[name]
+                elif all(dep in results for dep in deps):
+                    running[executor.submit(func, results)] = name
+                    del pending[name]
+            if not running:
+                # the rest depends on each other
+                for name in pending:
+                    errors[name] = Exception("dependency cycle")
+                break
+            done, _ = futures.wait(running,
+                                   return_when=futures.FIRST_COMPLETED)
+            for task in done:
+                name = running.pop(task)
+                try:
+                    results[name] = task.result()
+                    logger.debug("Task {} is done".format(name))
+                except Exception as e:
+                    logger.error("Task {} failed: {}".format(name, e))
+                    errors[name] = e
+    if errors:
+        raise GraphError(results, errors)
+    return results
@@ -0,0 +1,164 @@
+"""Image with iperf3 pre-installed, built once from image_name.
+
+The image name has the version of the build inputs: the base image id and
+checksum, the way iperf3 is installed (apt with iperf_prep_string or the
+offline .deb packages with their checksums) and BUILD_VERSION of the
+build steps. Any change of them gives a new name, so the image is rebuilt
+at the next run and the images of the previous versions are deleted.
+
+The iperf3 server is started at boot by systemd, so the VM preparation
+only checks it is listening.
+"""
+import hashlib
+import logging
+import time
+
+import utils
+from utils import os_client
+from utils import probe
+from utils import ssh
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'spt-iperf'
+# bump when the build steps change
+BUILD_VERSION = 1
+
+IPERF3_SERVICE = """[Unit]
+Description=iperf3 server for mos-spt
+After=network.target
+
+[Service]
+ExecStart=/usr/bin/iperf3 -s
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+
+def get_version(base_image, config):
+    """Short hash of all the build inputs."""
+    parts = [str(BUILD_VERSION), base_image['id'],
+             base_image.get('checksum') or '',
+             str(config.internet_at_vms)]
+    if config.internet_at_vms:
+        parts.append(config.iperf_prep_string)
+    else:
+        parts.extend(sorted(
+            ssh.get_md5(path) for path in ssh.get_deb_packages(
+                config.iperf_deb_package_dir_path or "/artifacts/mos-spt/")))
+    return hashlib.sha1("|".join(parts).encode('utf-8')).hexdigest()[:10]
+
+
+def get_image_name(base_image, version):
+    return "{}-{}-{}".format(PREFIX, base_image['name'], version)
+
+
+def wait_for_status(get_status, expected, timeout, what):
+    start_time = time.time()
+    while True:
+        status = get_status()
+        if status.lower() == expected:
+            return
+        if status.lower() in ('error', 'killed', 'deleted'):
+            raise Exception("{} is in {} status".format(what, status))
+        if (time.time() - start_time) > timeout:
+            raise TimeoutError("{} is in {} status after {} seconds".format(
+                what, status, timeout))
+        time.sleep(5)
+
+
+def build(os_clients, os_resources, base_image, name, version,
+          timeout=600):
+    """Boot a VM from the base image, install iperf3 and enable the
+    iperf3 server, then snapshot the stopped VM to the image.
+    :param os_resources: dict of the os_resources fixture, the VM is
+    booted in its net1 with its flavor, key pair and security group
+    :return: id of the image
+    """
+    os_actions = os_client.OSCliActions(os_clients)
+    compute = os_clients.compute
+    private_key = os_resources['keypair'].private_key
+    logger.info("Building image {} from {}...".format(
+        name, base_image['name']))
+    server = os_actions.create_basic_server(
+        image=base_image['id'], flavor=os_resources['flavor_id'],
+        net=os_resources['net1'],
+        sec_groups=[os_resources['sec_group'].name],
+        keypair=os_resources['keypair'].name,
+        name='spt-test-server-image-build')
+    fip = None
+    try:
+        os_actions.check_vms_are_active([server.id], timeout=timeout)
+        fip = compute.floating_ips.create(os_resources['ext_net']['name'])
+        server.add_floating_ip(fip)
+        result = probe.probe_all([fip.ip], 'ubuntu', private_key,
+                                 timeout=timeout)[fip.ip]
+        if not result.reachable:
+            raise TimeoutError("VM {} is not reachable via SSH: {}".format(
+                fip.ip, result.error))
+        ssh.prepare_iperf(fip.ip, private_key=private_key)
+        transport = ssh.SSHTransport(fip.ip, 'ubuntu',
+                                     private_key=private_key)
+        exit_status, _, stderr = transport.exec_sync(
+            "echo '{}' | sudo tee /etc/systemd/system/spt-iperf3.service "
+            "> /dev/null && sudo systemctl enable spt-iperf3 && "
+            "sudo sync".format(IPERF3_SERVICE))
+        if exit_status != 0:
+            raise Exception("Could not enable iperf3 service at {}: "
+                            "{}".format(fip.ip, stderr))
+        ssh.connection_pool.close(fip.ip)
+
+        # snapshot of the stopped VM is consistent
+        compute.servers.stop(server)
+        wait_for_status(lambda: compute.servers.get(server.id).status,
+                        'shutoff', timeout, "VM {}".format(server.id))
+        image_id = compute.servers.create_image(server, name, metadata={
+            'spt_base_image_id': base_image['id'],
+            'spt_version': version})
+        wait_for_status(
+            lambda: os_clients.image.images.get(image_id)['status'],
+            'active', timeout, "Image {}".format(name))
+        logger.info("Built image {} ({})".format(name, image_id))
+        return image_id
+    finally:
+        try:
+            os_actions.delete_servers([server], timeout=timeout)
+        finally:
+            # the FIP is not associated if add_floating_ip failed
+            if fip is not None and fip.id in [
+                    item.id for item in compute.floating_ips.list()]:
+                compute.floating_ips.delete(fip.id)
+
+
+def delete_old_images(image_client, base_image, keep_name):
+    prefix = "{}-{}-".format(PREFIX, base_image['name'])
+    for image in image_client.images.list():
+        if image['name'] and image['name'].startswith(prefix) and \
+                image['name'] != keep_name:
+            logger.info("Deleting image {} of an old version".format(
+                image['name']))
+            image_client.images.delete(image['id'])
+
+
+def get_prebuilt_image(os_clients, os_resources, base_image_id,
+                       timeout=600):
+    """Find the image of the current version or build it.
+    :return: id of the image
+    """
+    config = utils.get_configuration()
+    base_image = os_clients.image.images.get(base_image_id)
+    version = get_version(base_image, config)
+    name = get_image_name(base_image, version)
+    for image in os_clients.image.images.list(filters={'name': name}):
+        if image['status'] == 'active':
+            logger.info("Using pre-built image {}".format(name))
+            return image['id']
+        logger.info("Deleting image {} in {} status".format(
+            name, image['status']))
+        os_clients.image.images.delete(image['id'])
+    image_id = build(os_clients, os_resources, base_image, name, version,
+                     timeout=timeout)
+    delete_old_images(os_clients.image, base_image, name)
+    return image_id
@@ -0,0 +1,361 @@
+from collections import namedtuple
+from concurrent import futures
+import json
+import logging
+import math
+import re
+import statistics
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+IntervalSample = namedtuple('IntervalSample', [
+    'start', 'end', 'bits_per_second', 'retransmits'])
+
+IperfResult = namedtuple('IperfResult', [
+    'protocol',                 # 'TCP' or 'UDP'
+    'streams',                  # count of parallel streams
+    'duration',                 # seconds
+    'bits_per_second',          # sender side
+    'received_bits_per_second',
+    'retransmits',              # TCP only, None for UDP
+    'cpu_host',                 # total CPU utilization at the client, %
+    'cpu_remote',               # total CPU utilization at the server, %
+    'intervals',                # list of IntervalSample
+    'stop_reason',              # why the measurement was finished
+    'packets',                  # UDP only, sent datagrams
+    'jitter_ms',                # UDP only
+    'lost_percent',             # UDP only
+])
+
+# z-score of the 95% confidence interval
+Z_95 = 1.96
+
+# [  4]   0.00-1.00   sec   112 MBytes   941 Mbits/sec    0    540 KBytes
+# [SUM]   0.00-1.00   sec  1.09 GBytes  9.39 Gbits/sec   12
+INTERVAL_RE = re.compile(
+    r'^\[\s*(?P<stream>\d+|SUM)\]\s+(?P<start>[\d.]+)-(?P<end>[\d.]+)'
+    r'\s+sec\s+[\d.]+ \w?Bytes\s+(?P<rate>[\d.]+) (?P<unit>\w?)bits/sec'
+    r'(?:\s+(?P<retr>\d+))?')
+UNITS = {'': 1, 'K': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12}
+
+
+def format_bandwidth(bits_per_second):
+    """Human readable bandwidth like iperf3 prints it: 9.41 Gbits/sec"""
+    if bits_per_second is None:
+        return 'N/A'
+    for unit, factor in (('Gbits/sec', 1e9), ('Mbits/sec', 1e6),
+                         ('Kbits/sec', 1e3)):
+        if bits_per_second >= factor:
+            return "{:.2f} {}".format(bits_per_second / factor, unit)
+    return "{:.2f} bits/sec".format(bits_per_second)
+
+
+def parse_iperf_json(output):
+    """Parse the output of 'iperf3 -J' into IperfResult.
+    :param output: str or bytes with the iperf3 JSON report
+    :raises ValueError: if the output is not a valid successful report
+    """
+    if isinstance(output, bytes):
+        output = output.decode('utf-8')
+    try:
+        report = json.loads(output)
+    except ValueError:
+        raise ValueError("iperf3 returned not a JSON report: {}".format(
+            output[:500]))
+    if report.get('error'):
+        raise ValueError("iperf3 failed: {}".format(report['error']))
+
+    test_start = report.get('start', {}).get('test_start', {})
+    end = report.get('end', {})
+    # TCP reports have sum_sent/sum_received, UDP ones have sum
+    sent = end.get('sum_sent') or end.get('sum') or {}
+    received = end.get('sum_received') or end.get('sum') or {}
+    # UDP loss and jitter are measured by the server, 'sum' has them in
+    # all the iperf3 versions
+    udp = end.get('sum') or received
+    cpu = end.get('cpu_utilization_percent', {})
+
+    intervals = []
+    for interval in report.get('intervals', []):
+        interval_sum = interval.get('sum', {})
+        intervals.append(IntervalSample(
+            start=interval_sum.get('start'),
+            end=interval_sum.get('end'),
+            bits_per_second=interval_sum.get('bits_per_second'),
+            retransmits=interval_sum.get('retransmits')))
+
+    return IperfResult(
+        protocol=test_start.get('protocol', 'TCP'),
+        streams=test_start.get('num_streams', 1),
+        duration=sent.get('seconds') or test_start.get('duration'),
+        bits_per_second=sent.get('bits_per_second'),
+        received_bits_per_second=received.get('bits_per_second'),
+        retransmits=sent.get('retransmits'),
+        cpu_host=cpu.get('host_total'),
+        cpu_remote=cpu.get('remote_total'),
+        intervals=intervals,
+        stop_reason='fixed duration',
+        packets=udp.get('packets'),
+        jitter_ms=udp.get('jitter_ms'),
+        lost_percent=udp.get('lost_percent'))
+
+
+def iperf_client_cmd(server, iperf_time=60, options=''):
+    return " ".join(filter(None, [
+        'iperf3 -J -c', server, options, '-t {}'.format(iperf_time)]))
+
+
+def run_iperf(transport, server, iperf_time=60, options=''):
+    """Run iperf3 client at the VM of the transport against the server.
+    :param transport: SSHTransport to the client VM
+    :param server: iperf3 server address
+    :param options: extra iperf3 options like '-P 10'
+    :rtype: IperfResult
+    """
+    cmd = iperf_client_cmd(server, iperf_time, options)
+    exit_status, stdout, stderr = transport.exec_sync(cmd)
+    try:
+        return parse_iperf_json(stdout)
+    except ValueError as e:
+        raise ValueError("'{}' at {} (exit code {}): {} {}".format(
+            cmd, transport.address, exit_status, e,
+            stderr.decode('utf-8', 'replace')))
+
+
+def parse_interval_line(line, streams=1):
+    """Parse the per-interval line of the iperf3 text output.
+    With several streams only the [SUM] lines are taken.
+    :rtype: IntervalSample or None
+    """
+    if isinstance(line, bytes):
+        line = line.decode('utf-8', 'replace')
+    match = INTERVAL_RE.match(line.strip())
+    if match is None or 'sender' in line or 'receiver' in line:
+        return None
+    if (match.group('stream') == 'SUM') != (streams > 1):
+        return None
+    retr = match.group('retr')
+    return IntervalSample(
+        start=float(match.group('start')),
+        end=float(match.group('end')),
+        bits_per_second=float(match.group('rate')) *
+        UNITS[match.group('unit')],
+        retransmits=int(retr) if retr is not None else None)
+
+
+def confidence_half_width(samples):
+    """Relative half-width of the 95% confidence interval of the mean."""
+    if len(samples) < 2:
+        return None
+    mean = statistics.mean(samples)
+    if not mean:
+        return None
+    return Z_95 * statistics.stdev(samples) / math.sqrt(len(samples)) / mean
+
+
+def run_iperf_adaptive(transport, server, min_time=10, max_time=60,
+                       ci_percent=5.0, options=''):
+    """Run iperf3 client until the throughput converges.
+    The per-second samples are read as iperf3 prints them. The client is
+    stopped once min_time passed and the 95% confidence interval of the
+    mean throughput is within ci_percent of the mean, or after max_time.
+    The first second is not taken into account (TCP slow start).
+    :rtype: IperfResult
+    """
+    parallel = re.search(r'-P\s*(\d+)', options)
+    streams = int(parallel.group(1)) if parallel else 1
+    cmd = " ".join(filter(None, [
+        'stdbuf -oL iperf3 -i 1 -c', server, options,
+        '-t {}'.format(max_time)]))
+    # the shell prints its PID which exec passes to the client, so only
+    # this client is stopped, not the ones of the other measurements
+    stream = transport.exec_stream("echo $$; exec {}".format(cmd),
+                                   timeout=max_time + 30)
+    pid = None
+    intervals = []
+    stop_reason = None
+    for name, line in stream:
+        if name == 'stdout' and pid is None and line.strip().isdigit():
+            pid = int(line)
+            continue
+        sample = parse_interval_line(line, streams) \
+            if name == 'stdout' else None
+        if sample is None:
+            continue
+        intervals.append(sample)
+        samples = [i.bits_per_second for i in intervals if i.start >= 1]
+        half_width = confidence_half_width(samples)
+        if sample.end >= min_time and half_width is not None and \
+                half_width * 100 <= ci_percent:
+            stop_reason = ("converged after {:.0f} s: 95% CI is "
+                           "+-{:.2f}%".format(sample.end, half_width * 100))
+            stream.close()
+            # the client could still be running if it had nothing to write
+            if pid is not None:
+                transport.exec_sync("kill {} 2>/dev/null || true".format(
+                    pid))
+            break
+    if not intervals:
+        raise ValueError("'{}' at {} returned no interval samples (exit "
+                         "code {})".format(cmd, transport.address,
+                                           stream.exit_status))
+    if stop_reason is None:
+        half_width = confidence_half_width(
+            [i.bits_per_second for i in intervals if i.start >= 1])
+        stop_reason = "max duration {} s reached: 95% CI is {}".format(
+            max_time, "+-{:.2f}%".format(half_width * 100)
+            if half_width is not None else 'unknown')
+    logger.info("iperf3 to {}: {}".format(server, stop_reason))
+    samples = [i for i in intervals if i.start >= 1] or intervals
+    retransmits = [i.retransmits for i in intervals
+                   if i.retransmits is not None]
+    return IperfResult(
+        protocol='TCP',
+        streams=streams,
+        duration=intervals[-1].end,
+        bits_per_second=statistics.mean(i.bits_per_second
+                                        for i in samples),
+        received_bits_per_second=None,
+        retransmits=sum(retransmits) if retransmits else None,
+        cpu_host=None,
+        cpu_remote=None,
+        intervals=intervals,
+        stop_reason=stop_reason,
+        packets=None,
+        jitter_ms=None,
+        lost_percent=None)
+
+
+# threads (and SSH sessions) started by run_synchronized at once
+MAX_SYNCHRONIZED_FLOWS = 256
+
+
+def run_synchronized(flows, iperf_time=60, options='', barrier_timeout=120,
+                     max_flows=MAX_SYNCHRONIZED_FLOWS):
+    """Start all the iperf3 clients at the same moment.
+    The SSH connections are opened before the start barrier, so the
+    clients start within the time of one exec request. Each flow needs its
+    own thread waiting at the barrier, so the thread count is the count of
+    the flows, limited by max_flows.
+    :param flows: list of (SSHTransport of the client, server address),
+    each server should get one flow
+    :return: list of IperfResult in the order of the flows
+    :raises ValueError: if there are more than max_flows flows
+    """
+    if len(flows) > max_flows:
+        raise ValueError("{} flows are more than {} which can be started "
+                         "at once".format(len(flows), max_flows))
+    barrier = threading.Barrier(len(flows), timeout=barrier_timeout)
+
+    def run(flow):
+        transport, server = flow
+        try:
+            transport.exec_sync('true')
+        except Exception:
+            barrier.abort()
+            raise
+        barrier.wait()
+        return run_iperf(transport, server, iperf_time, options)
+
+    with futures.ThreadPoolExecutor(max_workers=len(flows)) as executor:
+        return list(executor.map(run, flows))
+
+
+def jain_index(values):
+    """Jain's fairness index: 1 if all the values are equal, 1/n if one
+    value takes everything."""
+    if not values or not any(values):
+        return None
+    return sum(values) ** 2 / (len(values) * sum(v ** 2 for v in values))
+
+
+def summarize_flows(results):
+    """Aggregate and fairness of the concurrent flows.
+    :param results: list of IperfResult
+    :return: dict with the aggregate, min, mean and max bits per second,
+    Jain's fairness index and the spread (max - min) / mean
+    """
+    values = [result.bits_per_second or 0 for result in results]
+    mean = statistics.mean(values)
+    return {
+        'flows': len(values),
+        'aggregate_bps': sum(values),
+        'min_bps': min(values),
+        'mean_bps': mean,
+        'max_bps': max(values),
+        'fairness': jain_index(values),
+        'spread': (max(values) - min(values)) / mean if mean else None,
+        'retransmits': sum(result.retransmits or 0 for result in results),
+    }
+
+
+def get_pps(result):
+    """Packets per second of UDP, None for TCP: iperf3 does not count the
+    TCP segments."""
+    if result.packets is not None and result.duration:
+        return result.packets / result.duration
+    return None
+
+
+def find_knee(points, min_gain=0.1):
+    """Find the point after which the curve stops growing: the next point
+    gives less than min_gain relative increase.
+    :param points: list of (x, y) in the sweep order
+    :return: the x of the knee or None if it grows up to the last point
+    """
+    for (x, y), (_, next_y) in zip(points, points[1:]):
+        if y is not None and next_y is not None and \
+                next_y < y * (1 + min_gain):
+            return x
+    return None
+
+
+def parse_rate(rate):
+    """iperf3 rate like 100M or 10G in bits/s."""
+    rate = str(rate).strip()
+    if rate[-1:].upper() in UNITS:
+        return float(rate[:-1]) * UNITS[rate[-1:].upper()]
+    return float(rate)
+
+
+def get_received_pps(result):
+    """UDP datagrams per second which reached the server."""
+    if result.packets is None or not result.duration:
+        return None
+    return result.packets * (1 - (result.lost_percent or 0) / 100.0) / \
+        result.duration
+
+
+def run_udp(transport, server, rate, length, iperf_time=10):
+    """UDP datagrams of the length in bytes at the rate (bits/s or iperf3
+    -b value like '100M')."""
+    return run_iperf(transport, server, iperf_time,
+                     "-u -b {} -l {}".format(rate, length))
+
+
+def search_udp_rate(transport, server, length, max_rate, iperf_time=5,
+                    loss_percent=0.0, precision=0.05, max_steps=10):
+    """Binary search of the highest UDP rate with the loss within
+    loss_percent, starting from max_rate bits/s.
+    :return: tuple of the rate and its IperfResult, (None, None) if even
+    the lowest tried rate has loss
+    """
+    low, high = 0, max_rate
+    best = (None, None)
+    rate = max_rate
+    for _ in range(max_steps):
+        result = run_udp(transport, server, int(rate), length, iperf_time)
+        lost = result.lost_percent
+        logger.info("UDP {} bytes at {}: loss {}%".format(
+            length, format_bandwidth(rate), lost))
+        if lost is not None and lost <= loss_percent:
+            low = rate
+            best = (rate, result)
+        else:
+            high = rate
+        if high - low <= precision * high:
+            break
+        rate = (low + high) / 2.0
+    return best
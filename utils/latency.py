@@ -0,0 +1,190 @@
+"""Round-trip latency between the VMs.
+
+The samples are streamed from the VM line by line and counted into a
+LatencyHistogram, the raw samples are not kept:
+
+* ICMP - ping, one sample per echo reply
+* TCP request/response - a one byte request and response over one
+  TCP_NODELAY connection to the echo server at ECHO_PORT, done with
+  python3 of the VM
+"""
+import logging
+import math
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+ECHO_PORT = 5202
+ECHO_SERVER_PATH = '/tmp/spt_echo_server.py'
+RR_CLIENT_PATH = '/tmp/spt_rr_client.py'
+
+ECHO_SERVER = """import socket
+import threading
+
+
+def serve(conn):
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    while True:
+        data = conn.recv(64)
+        if not data:
+            break
+        conn.sendall(data)
+    conn.close()
+
+
+sock = socket.socket()
+sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+sock.bind(('', {port}))
+sock.listen(16)
+while True:
+    conn, _ = sock.accept()
+    threading.Thread(target=serve, args=(conn,), daemon=True).start()
+"""
+
+# prints the round-trip time of each request in microseconds
+RR_CLIENT = """import socket
+import sys
+import time
+
+host, port, count, interval = sys.argv[1:]
+sock = socket.create_connection((host, int(port)), timeout=10)
+sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+for _ in range(int(count)):
+    start = time.perf_counter()
+    sock.sendall(b'x')
+    if not sock.recv(1):
+        sys.exit('connection closed')
+    print(int((time.perf_counter() - start) * 1e6), flush=True)
+    time.sleep(float(interval))
+"""
+
+PING_RE = re.compile(r'time=(?P<time>[\d.]+) ms')
+
+
+class LatencyHistogram(object):
+    """Log-linear histogram of the latencies in microseconds.
+
+    Each power of two range is split into sub_buckets linear buckets, so
+    the relative error of a percentile is within 1 / sub_buckets whatever
+    the count of the samples is. The min and max values are exact.
+    """
+
+    def __init__(self, sub_buckets=32):
+        self.sub_buckets = sub_buckets
+        self.counts = {}
+        self.count = 0
+        self.min = None
+        self.max = None
+
+    def _get_bucket(self, value):
+        if value < 1:
+            return 0, 0
+        # value = mantissa * 2 ** exponent with mantissa in [0.5, 1), exact
+        # at the powers of two unlike the rounded math.log(value, 2)
+        mantissa, exponent = math.frexp(value)
+        sub = int((mantissa * 2 - 1) * self.sub_buckets)
+        return exponent, min(sub, self.sub_buckets - 1)
+
+    def _get_upper_bound(self, bucket):
+        exponent, sub = bucket
+        if exponent == 0:
+            return 1
+        return 2.0 ** (exponent - 1) * (1 + (sub + 1.0) / self.sub_buckets)
+
+    def record(self, value):
+        bucket = self._get_bucket(value)
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percent):
+        """Upper bound of the bucket of the percentile, at most max."""
+        if not self.count:
+            return None
+        rank = max(int(math.ceil(percent / 100.0 * self.count)), 1)
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                return min(self._get_upper_bound(bucket), self.max)
+        return self.max
+
+    def summary(self):
+        """Percentiles in milliseconds."""
+        result = {'samples': self.count}
+        for name, percent in (('p50', 50), ('p90', 90), ('p99', 99),
+                              ('p99.9', 99.9)):
+            value = self.percentile(percent)
+            result[name] = value / 1000.0 if value is not None else None
+        result['max'] = self.max / 1000.0 if self.max is not None else None
+        return result
+
+
+def measure_icmp(transport, address, count=1000, interval=0.2):
+    """ping the address from the VM of the transport.
+    :rtype: LatencyHistogram
+    """
+    histogram = LatencyHistogram()
+    stream = transport.exec_stream(
+        "ping -n -c {} -i {} {}".format(count, interval, address),
+        timeout=count * (interval + 1) + 30)
+    for name, line in stream:
+        match = PING_RE.search(line.decode('utf-8', 'replace'))
+        if name == 'stdout' and match:
+            histogram.record(float(match.group('time')) * 1000)
+    if not histogram.count:
+        raise ValueError("No ping replies from {} at {} (exit code "
+                         "{})".format(address, transport.address,
+                                      stream.exit_status))
+    return histogram
+
+
+def put_script(transport, path, script):
+    exit_status, _, stderr = transport.exec_sync(
+        "cat > {} <<'EOF'\n{}EOF".format(path, script))
+    if exit_status != 0:
+        raise Exception("Could not write {} at {}: {}".format(
+            path, transport.address, stderr))
+
+
+def start_echo_server(transport, port=ECHO_PORT, timeout=30):
+    """Start the TCP echo server at the VM unless it is running."""
+    exit_status, _, _ = transport.exec_sync(
+        "ss -ltn | grep -q ':{} '".format(port))
+    if exit_status == 0:
+        return
+    put_script(transport, ECHO_SERVER_PATH, ECHO_SERVER.format(port=port))
+    transport.exec_sync("nohup python3 {} > /dev/null 2>&1 &".format(
+        ECHO_SERVER_PATH))
+    for _ in range(timeout):
+        exit_status, _, _ = transport.exec_sync(
+            "ss -ltn | grep -q ':{} '".format(port))
+        if exit_status == 0:
+            return
+        time.sleep(1)
+    raise TimeoutError("TCP echo server is not listening at {}:{} after {} "
+                       "seconds.".format(transport.address, port, timeout))
+
+
+def measure_tcp_rr(transport, address, count=1000, interval=0.01,
+                   port=ECHO_PORT):
+    """One byte TCP request/response from the VM of the transport to
+    the echo server at the address.
+    :rtype: LatencyHistogram
+    """
+    put_script(transport, RR_CLIENT_PATH, RR_CLIENT)
+    histogram = LatencyHistogram()
+    stream = transport.exec_stream(
+        "python3 {} {} {} {} {}".format(RR_CLIENT_PATH, address, port,
+                                        count, interval),
+        timeout=count * (interval + 1) + 30)
+    for name, line in stream:
+        if name == 'stdout' and line.strip().isdigit():
+            histogram.record(int(line))
+    if not histogram.count:
+        raise ValueError("No TCP responses from {}:{} at {} (exit code "
+                         "{})".format(address, port, transport.address,
+                                      stream.exit_status))
+    return histogram
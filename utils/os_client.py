@@ -6,9 +6,12 @@ from keystoneclient.v3 import client as keystone_client
 from neutronclient.v2_0 import client as neutron_client
 from novaclient import client as novaclient
 
+from concurrent import futures
 import logging
 import os
 import random
+import requests
+import threading
 import time
 
 import utils
@@ -16,6 +19,45 @@ import utils
 logger = logging.getLogger(__name__)
 
 
+SEC_GROUP_RULES = [
+    {
+        # ssh
+        'ip_protocol': 'tcp',
+        'from_port': 22,
+        'to_port': 22,
+        'cidr': '0.0.0.0/0',
+    },
+    {
+        # iperf3
+        'ip_protocol': 'tcp',
+        'from_port': 5201,
+        'to_port': 5201,
+        'cidr': '0.0.0.0/0',
+    },
+    {
+        # iperf3 UDP tests
+        'ip_protocol': 'udp',
+        'from_port': 5201,
+        'to_port': 5201,
+        'cidr': '0.0.0.0/0',
+    },
+    {
+        # TCP request/response latency
+        'ip_protocol': 'tcp',
+        'from_port': 5202,
+        'to_port': 5202,
+        'cidr': '0.0.0.0/0',
+    },
+    {
+        # ping
+        'ip_protocol': 'icmp',
+        'from_port': -1,
+        'to_port': -1,
+        'cidr': '0.0.0.0/0',
+    }
+]
+
+
 class OfficialClientManager(object):
     """Manager that provides access to the official python clients for
     calling various OpenStack APIs.
@@ -30,9 +72,14 @@ class OfficialClientManager(object):
     if "OS_ENDPOINT_TYPE" in list(os.environ.keys()):
         INTERFACE = os.environ["OS_ENDPOINT_TYPE"]
 
+    # size of the HTTP connection pool per host shared by all the clients
+    HTTP_POOL_MAXSIZE = 32
+    # the token is refreshed when it expires in less than this, seconds
+    TOKEN_REFRESH_MARGIN = 300
+
     def __init__(self, username=None, password=None,
                  tenant_name=None, auth_url=None, endpoint_type="internalURL",
-                 cert=False, domain="Default", **kwargs):
+                 cert=False, domain="Default", pool_maxsize=None, **kwargs):
         self.traceback = ""
 
         self.client_attr_names = [
@@ -50,8 +97,13 @@ class OfficialClientManager(object):
         self.endpoint_type = endpoint_type
         self.cert = cert
         self.domain = domain
+        self.pool_maxsize = pool_maxsize or self.HTTP_POOL_MAXSIZE
         self.kwargs = kwargs
 
+        # One authenticated session is shared by all the clients
+        self._lock = threading.RLock()
+        self._session = None
+
         # Lazy clients
         self._auth = None
         self._compute = None
@@ -62,7 +114,7 @@ class OfficialClientManager(object):
     @classmethod
     def _get_auth_session(cls, username=None, password=None,
                           tenant_name=None, auth_url=None, cert=None,
-                          domain='Default'):
+                          domain='Default', pool_maxsize=None):
         if None in (username, password, tenant_name):
             print((username, password, tenant_name))
             msg = ("Missing required credentials for identity client. "
@@ -93,21 +145,48 @@ class OfficialClientManager(object):
                 project_domain_name=domain,
                 project_name=tenant_name)
 
-        auth_session = keystone_session.Session(auth=auth, verify=cert)
-        # auth_session.get_auth_headers()
+        # refresh the token in advance instead of failing a request
+        auth.MIN_TOKEN_LIFE_SECONDS = cls.TOKEN_REFRESH_MARGIN
+
+        http_session = None
+        if pool_maxsize:
+            http_session = requests.Session()
+            adapter = keystone_session.TCPKeepAliveAdapter(
+                pool_connections=pool_maxsize, pool_maxsize=pool_maxsize)
+            http_session.mount('https://', adapter)
+            http_session.mount('http://', adapter)
+
+        auth_session = keystone_session.Session(auth=auth, verify=cert,
+                                                session=http_session)
         return auth_session
 
+    @property
+    def session(self):
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    session = self._get_auth_session(
+                        username=self.username, password=self.password,
+                        tenant_name=self.tenant_name,
+                        auth_url=self.auth_url, cert=self.cert,
+                        domain=self.domain, pool_maxsize=self.pool_maxsize)
+                    # issue the token once before the clients share it
+                    session.get_auth_headers()
+                    self._session = session
+        return self._session
+
     @classmethod
     def get_auth_client(cls, username=None, password=None,
                         tenant_name=None, auth_url=None, cert=None,
-                        domain='Default', **kwargs):
-        session = cls._get_auth_session(
-            username=username,
-            password=password,
-            tenant_name=tenant_name,
-            auth_url=auth_url,
-            cert=cert,
-            domain=domain)
+                        domain='Default', session=None, **kwargs):
+        if session is None:
+            session = cls._get_auth_session(
+                username=username,
+                password=password,
+                tenant_name=tenant_name,
+                auth_url=auth_url,
+                cert=cert,
+                domain=domain)
         keystone = keystone_client.Client(version=cls.KEYSTONECLIENT_VERSION,
                                           session=session, **kwargs)
         keystone.management_url = auth_url
@@ -116,10 +195,11 @@ class OfficialClientManager(object):
     @classmethod
     def get_compute_client(cls, username=None, password=None,
                            tenant_name=None, auth_url=None, cert=None,
-                           domain='Default', **kwargs):
-        session = cls._get_auth_session(
-            username=username, password=password, tenant_name=tenant_name,
-            auth_url=auth_url, cert=cert, domain=domain)
+                           domain='Default', session=None, **kwargs):
+        if session is None:
+            session = cls._get_auth_session(
+                username=username, password=password, tenant_name=tenant_name,
+                auth_url=auth_url, cert=cert, domain=domain)
         service_type = 'compute'
         compute_client = novaclient.Client(
             version=cls.NOVACLIENT_VERSION, session=session,
@@ -129,10 +209,11 @@ class OfficialClientManager(object):
     @classmethod
     def get_network_client(cls, username=None, password=None,
                            tenant_name=None, auth_url=None, cert=None,
-                           domain='Default', **kwargs):
-        session = cls._get_auth_session(
-            username=username, password=password, tenant_name=tenant_name,
-            auth_url=auth_url, cert=cert, domain=domain)
+                           domain='Default', session=None, **kwargs):
+        if session is None:
+            session = cls._get_auth_session(
+                username=username, password=password, tenant_name=tenant_name,
+                auth_url=auth_url, cert=cert, domain=domain)
         service_type = 'network'
         return neutron_client.Client(
             service_type=service_type, session=session,
@@ -141,10 +222,11 @@ class OfficialClientManager(object):
     @classmethod
     def get_volume_client(cls, username=None, password=None,
                           tenant_name=None, auth_url=None, cert=None,
-                          domain='Default', **kwargs):
-        session = cls._get_auth_session(
-            username=username, password=password, tenant_name=tenant_name,
-            auth_url=auth_url, cert=cert, domain=domain)
+                          domain='Default', session=None, **kwargs):
+        if session is None:
+            session = cls._get_auth_session(
+                username=username, password=password, tenant_name=tenant_name,
+                auth_url=auth_url, cert=cert, domain=domain)
         service_type = 'volume'
         return cinder_client.Client(
             version=cls.CINDERCLIENT_VERSION,
@@ -155,10 +237,11 @@ class OfficialClientManager(object):
     @classmethod
     def get_image_client(cls, username=None, password=None,
                          tenant_name=None, auth_url=None, cert=None,
-                         domain='Default', **kwargs):
-        session = cls._get_auth_session(
-            username=username, password=password, tenant_name=tenant_name,
-            auth_url=auth_url, cert=cert, domain=domain)
+                         domain='Default', session=None, **kwargs):
+        if session is None:
+            session = cls._get_auth_session(
+                username=username, password=password, tenant_name=tenant_name,
+                auth_url=auth_url, cert=cert, domain=domain)
         service_type = 'image'
         return glance_client.Client(
             version=cls.GLANCECLIENT_VERSION,
@@ -169,47 +252,65 @@ class OfficialClientManager(object):
     @property
     def auth(self):
         if self._auth is None:
-            self._auth = self.get_auth_client(
-                self.username, self.password, self.tenant_name, self.auth_url,
-                self.cert, self.domain, endpoint_type=self.endpoint_type
-            )
+            with self._lock:
+                if self._auth is None:
+                    self._auth = self.get_auth_client(
+                        self.username, self.password, self.tenant_name,
+                        self.auth_url, self.cert, self.domain,
+                        session=self.session,
+                        endpoint_type=self.endpoint_type
+                    )
         return self._auth
 
     @property
     def compute(self):
         if self._compute is None:
-            self._compute = self.get_compute_client(
-                self.username, self.password, self.tenant_name, self.auth_url,
-                self.cert, self.domain, endpoint_type=self.endpoint_type
-            )
+            with self._lock:
+                if self._compute is None:
+                    self._compute = self.get_compute_client(
+                        self.username, self.password, self.tenant_name,
+                        self.auth_url, self.cert, self.domain,
+                        session=self.session,
+                        endpoint_type=self.endpoint_type
+                    )
         return self._compute
 
     @property
     def network(self):
         if self._network is None:
-            self._network = self.get_network_client(
-                self.username, self.password, self.tenant_name, self.auth_url,
-                self.cert, self.domain, endpoint_type=self.endpoint_type
-            )
+            with self._lock:
+                if self._network is None:
+                    self._network = self.get_network_client(
+                        self.username, self.password, self.tenant_name,
+                        self.auth_url, self.cert, self.domain,
+                        session=self.session,
+                        endpoint_type=self.endpoint_type
+                    )
         return self._network
 
     @property
     def volume(self):
         if self._volume is None:
-            self._volume = self.get_volume_client(
-                self.username, self.password, self.tenant_name, self.auth_url,
-                self.cert, self.domain, endpoint_type=self.endpoint_type
-            )
+            with self._lock:
+                if self._volume is None:
+                    self._volume = self.get_volume_client(
+                        self.username, self.password, self.tenant_name,
+                        self.auth_url, self.cert, self.domain,
+                        session=self.session,
+                        endpoint_type=self.endpoint_type
+                    )
         return self._volume
 
     @property
     def image(self):
-
         if self._image is None:
-            self._image = self.get_image_client(
-                self.username, self.password, self.tenant_name, self.auth_url,
-                self.cert, self.domain
-            )
+            with self._lock:
+                if self._image is None:
+                    self._image = self.get_image_client(
+                        self.username, self.password, self.tenant_name,
+                        self.auth_url, self.cert, self.domain,
+                        session=self.session
+                    )
         return self._image
 
 
@@ -234,10 +335,11 @@ class OSCliActions(object):
             net = self.create_network_resources()
         return net
 
-    def create_fake_external_network(self):
+    def create_fake_external_network(self, name=None):
         logger.info(
             "Could not find any external network, creating a fake one...")
-        net_name = "spt-ext-net-{}".format(random.randrange(100, 999))
+        net_name = name or "spt-ext-net-{}".format(
+            random.randrange(100, 999))
         net_body = {"network": {"name": net_name,
                                 "router:external": True,
                                 "provider:network_type": "local"}}
@@ -250,7 +352,7 @@ class OSCliActions(object):
             net_body["network"].pop('provider:network_type', None)
             ext_net = \
                 self.os_clients.network.create_network(net_body)['network']
-        subnet_name = "spt-ext-subnet-{}".format(random.randrange(100, 999))
+        subnet_name = "{}-subnet".format(net_name)
         subnet_body = {
             "subnet": {
                 "name": subnet_name,
@@ -265,9 +367,13 @@ class OSCliActions(object):
         self.create_fake_ext_net = True
         return ext_net
 
-    def get_external_network(self):
-        config = utils.get_configuration()
-        ext_net = config.get('external_network') or ''
+    def get_external_network(self, fake_name=None):
+        """The configured external network, any external one if it is not
+        configured, or a fake one.
+        :param fake_name: fixed name of the fake network to reuse it if it
+        exists already
+        """
+        ext_net = utils.get_configuration().external_network
         if not ext_net:
             networks = [
                 net for net in
@@ -280,43 +386,25 @@ class OSCliActions(object):
                         self.os_clients.network.list_networks()["networks"]
                         if net["name"] == ext_net]
 
+        if not networks and fake_name:
+            networks = self.os_clients.network.list_networks(
+                name=fake_name)["networks"]
         if networks:
             ext_net = networks[0]
             logger.info("Using external net '{}'.".format(ext_net["name"]))
         else:
-            ext_net = self.create_fake_external_network()
+            ext_net = self.create_fake_external_network(name=fake_name)
         return ext_net
 
     def create_flavor(self, name, ram=256, vcpus=1, disk=2):
         logger.info("Creating a flavor {}".format(name))
         return self.os_clients.compute.flavors.create(name, ram, vcpus, disk)
 
-    def create_sec_group(self, rulesets=None):
+    def create_sec_group(self, rulesets=None, name=None):
         if rulesets is None:
-            rulesets = [
-                {
-                    # ssh
-                    'ip_protocol': 'tcp',
-                    'from_port': 22,
-                    'to_port': 22,
-                    'cidr': '0.0.0.0/0',
-                },
-                {
-                    # iperf3
-                    'ip_protocol': 'tcp',
-                    'from_port': 5201,
-                    'to_port': 5201,
-                    'cidr': '0.0.0.0/0',
-                },
-                {
-                    # ping
-                    'ip_protocol': 'icmp',
-                    'from_port': -1,
-                    'to_port': -1,
-                    'cidr': '0.0.0.0/0',
-                }
-            ]
-        sg_name = "spt-test-secgroup-{}".format(random.randrange(100, 999))
+            rulesets = SEC_GROUP_RULES
+        sg_name = name or "spt-test-secgroup-{}".format(
+            random.randrange(100, 999))
         sg_desc = sg_name + " SPT"
         secgroup = self.os_clients.compute.security_groups.create(
             sg_name, sg_desc)
@@ -328,19 +416,88 @@ class OSCliActions(object):
 
     def create_basic_server(self, image=None, flavor=None, net=None,
                             availability_zone=None, sec_groups=(),
-                            keypair=None):
+                            keypair=None, name=None, meta=None):
         os_conn = self.os_clients
         net = net or self.get_internal_network()
         kwargs = {}
         if sec_groups:
             kwargs['security_groups'] = sec_groups
+        if meta:
+            kwargs['meta'] = meta
         server = os_conn.compute.servers.create(
-            "spt-test-server-{}".format(random.randrange(100, 999)),
+            name or "spt-test-server-{}".format(random.randrange(100, 999)),
             image, flavor, nics=[{"net-id": net["id"]}],
             availability_zone=availability_zone, key_name=keypair, **kwargs)
 
         return server
 
+    def create_servers(self, servers_args):
+        """Boot several VMs at the same time.
+        :param servers_args: list of dicts with create_basic_server kwargs
+        :return: list of the created servers in the same order
+        """
+        servers = [None] * len(servers_args)
+        errors = []
+        with futures.ThreadPoolExecutor(
+                max_workers=max(len(servers_args), 1)) as executor:
+            tasks = {executor.submit(self.create_basic_server, **args): i
+                     for i, args in enumerate(servers_args)}
+            for task in futures.as_completed(tasks):
+                try:
+                    servers[tasks[task]] = task.result()
+                except Exception as e:
+                    errors.append(e)
+        if errors:
+            # do not leave the half of the VMs behind
+            for server in servers:
+                if server is not None:
+                    self.os_clients.compute.servers.delete(server)
+            raise errors[0]
+        return servers
+
+    def delete_servers(self, servers, timeout=300, retry_delay=5,
+                       name_filter='spt-'):
+        """Release the floating IPs of the VMs and delete the VMs at the
+        same time, then wait until all of them are gone.
+        :param servers: list of the servers or their ids
+        :raises TimeoutError: if some VMs are still present after timeout
+        """
+        compute = self.os_clients.compute
+        vm_ids = set(getattr(server, 'id', server) for server in servers)
+        if not vm_ids:
+            return
+        fips = [fip.id for fip in compute.floating_ips.list()
+                if fip.instance_id in vm_ids]
+        with futures.ThreadPoolExecutor(
+                max_workers=min(len(vm_ids) + len(fips), 16)) as executor:
+            tasks = [executor.submit(compute.floating_ips.delete, fip)
+                     for fip in fips]
+            tasks += [executor.submit(compute.servers.delete, vm_id)
+                      for vm_id in vm_ids]
+            for task in futures.as_completed(tasks):
+                try:
+                    task.result()
+                except Exception as e:
+                    # the VM or FIP could be deleted already, the wait
+                    # below tells whether the VM is gone
+                    logger.warning("Could not delete: {}".format(e))
+        pending = vm_ids
+        delay = 1
+        start_time = time.time()
+        while True:
+            pending = vm_ids & set(
+                vm.id for vm in compute.servers.list(
+                    search_opts={'name': name_filter}))
+            if not pending:
+                logger.info("Deleted VMs {}.".format(", ".join(vm_ids)))
+                return
+            if (time.time() - start_time) > timeout:
+                raise TimeoutError(
+                    "VMs {} are not deleted in {} seconds.".format(
+                        ", ".join(pending), timeout))
+            time.sleep(delay)
+            delay = min(delay * 2, retry_delay)
+
     def get_vm(self, vm_id):
         os_conn = self.os_clients
         try:
@@ -374,8 +531,48 @@ class OSCliActions(object):
                     vm_uuid=vm_uuid, expected_state=expected_state,
                     actual=vm.status))
 
-    def create_network(self, tenant_id):
-        net_name = "spt-test-net-{}".format(random.randrange(100, 999))
+    def check_vms_are_active(self, vm_uuids, retry_delay=5, timeout=500,
+                             name_filter='spt-test-server-'):
+        """Wait for several VMs to leave the BUILD state.
+        All the VMs are polled with one filtered servers.list call per
+        iteration, the delay between the polls grows up to retry_delay.
+        :return: dict with VM uuid as a key and the up-to-date server
+        """
+        expected_state = 'ACTIVE'
+        pending = set(vm_uuids)
+        servers = {}
+        delay = 1
+        start_time = time.time()
+        while True:
+            for vm in self.os_clients.compute.servers.list(
+                    search_opts={'name': name_filter}):
+                if vm.id not in pending:
+                    continue
+                servers[vm.id] = vm
+                if vm.status in (expected_state, 'ERROR'):
+                    logger.info(
+                        "VM {} is in {} status.".format(vm.id, vm.status))
+                    pending.discard(vm.id)
+            if not pending or (time.time() - start_time) > timeout:
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, retry_delay)
+
+        failed = ["{} ('{}')".format(
+            vm_uuid, servers[vm_uuid].status if vm_uuid in servers
+            else 'NOT FOUND') for vm_uuid in vm_uuids
+            if vm_uuid not in servers or
+            servers[vm_uuid].status != expected_state]
+        if failed:
+            raise TimeoutError(
+                "VMs are expected to be in '{expected_state}' state, but "
+                "some of them are not: {actual}".format(
+                    expected_state=expected_state,
+                    actual=", ".join(failed)))
+        return servers
+
+    def create_network(self, tenant_id, name=None):
+        net_name = name or "spt-test-net-{}".format(random.randrange(100, 999))
         net_body = {
             'network': {
                 'name': net_name,
@@ -401,8 +598,8 @@ class OSCliActions(object):
         logger.info("Created subnet {}".format(subnet_name))
         return subnet
 
-    def create_router(self, ext_net, tenant_id):
-        name = 'spt-test-router-{}'.format(random.randrange(100, 999))
+    def create_router(self, ext_net, tenant_id, name=None):
+        name = name or 'spt-test-router-{}'.format(random.randrange(100, 999))
         router_body = {
             'router': {
                 'name': name,
@@ -416,6 +613,25 @@ class OSCliActions(object):
         router = self.os_clients.network.create_router(router_body)['router']
         return router
 
+    def wait_for_ports_deleted(self, timeout=60, retry_delay=1,
+                               ignored_owners=('network:dhcp',), **filters):
+        """Wait until there are no ports matching the filters except the
+        ones of ignored_owners, e.g. DHCP ports are deleted by Neutron
+        together with the network."""
+        start_time = time.time()
+        while True:
+            ports = [port for port in
+                     self.os_clients.network.list_ports(**filters)['ports']
+                     if port['device_owner'] not in ignored_owners]
+            if not ports:
+                return
+            if (time.time() - start_time) > timeout:
+                raise TimeoutError(
+                    "Ports {} ({}) are not deleted in {} seconds.".format(
+                        ", ".join(port['id'] for port in ports), filters,
+                        timeout))
+            time.sleep(retry_delay)
+
     def create_network_resources(self):
         tenant_id = self.get_admin_tenant().id
         self.get_external_network()
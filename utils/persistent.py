@@ -0,0 +1,276 @@
+"""Warm resources kept between the runs.
+
+In persistent mode the resources have fixed names starting with
+'spt-persistent-' and are not deleted after the tests. The next run finds
+them, checks their health, reuses the healthy ones and recreates only the
+missing or broken ones. The VMs are kept per compute host together with
+their floating IPs and the installed iperf3.
+
+Delete all of them with:
+    python -m utils.persistent purge
+"""
+from io import StringIO
+import logging
+import os
+import sys
+
+import paramiko
+
+import utils
+from utils import os_client
+from utils import probe
+from utils import ssh
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'spt-persistent'
+
+
+def get_name(kind, *parts):
+    return '-'.join([PREFIX, kind] + [str(part) for part in parts])
+
+
+def get_fingerprint(private_key):
+    key = paramiko.RSAKey.from_private_key(StringIO(private_key))
+    return ':'.join('{:02x}'.format(byte) for byte in key.get_fingerprint())
+
+
+def get_floating_ip(server):
+    """Address of the floating IP associated with the server, if any."""
+    for addresses in server.addresses.values():
+        for address in addresses:
+            if address.get('OS-EXT-IPS:type') == 'floating':
+                return address['addr']
+    return None
+
+
+class PersistentResources(object):
+    """Find-or-create of the resources used by the tests."""
+
+    def __init__(self, os_actions, state_dir):
+        self.os_actions = os_actions
+        self.os_clients = os_actions.os_clients
+        self.state_dir = os.path.expanduser(state_dir)
+        self.key_path = os.path.join(self.state_dir,
+                                     get_name('key') + '.pem')
+
+    def sec_group(self):
+        name = get_name('secgroup')
+        for secgroup in self.os_clients.compute.security_groups.list():
+            if secgroup.name == name:
+                logger.info("Reusing security group {}".format(name))
+                self._add_missing_rules(secgroup)
+                return secgroup
+        return self.os_actions.create_sec_group(name=name)
+
+    def _add_missing_rules(self, secgroup):
+        """The rules added to the tests after the group was created."""
+        present = set((rule['ip_protocol'], rule['from_port'])
+                      for rule in secgroup.rules)
+        for rule in os_client.SEC_GROUP_RULES:
+            if (rule['ip_protocol'], rule['from_port']) not in present:
+                logger.info("Adding {} {} rule to security group {}".format(
+                    rule['ip_protocol'], rule['from_port'], secgroup.name))
+                self.os_clients.compute.security_group_rules.create(
+                    secgroup.id, **rule)
+
+    def keypair(self):
+        """The private key is kept at the state directory, the key pair is
+        recreated if the private key is lost or does not match."""
+        name = get_name('key')
+        keypairs = {kp.name: kp for kp in
+                    self.os_clients.compute.keypairs.list()}
+        if name in keypairs and os.path.exists(self.key_path):
+            with open(self.key_path) as key_file:
+                private_key = key_file.read()
+            if keypairs[name].fingerprint == get_fingerprint(private_key):
+                logger.info("Reusing key pair {}".format(name))
+                keypair = keypairs[name]
+                keypair.private_key = private_key
+                return keypair
+        if name in keypairs:
+            logger.info("Key pair {} does not match the local private key "
+                        "{}, recreating".format(name, self.key_path))
+            self.os_clients.compute.keypairs.delete(name)
+        keypair = self.os_clients.compute.keypairs.create(name)
+        if not os.path.isdir(self.state_dir):
+            os.makedirs(self.state_dir)
+        with os.fdopen(os.open(self.key_path,
+                               os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                               0o600), 'w') as key_file:
+            key_file.write(keypair.private_key)
+        logger.info("Created key pair {}, the private key is saved to "
+                    "{}".format(name, self.key_path))
+        return keypair
+
+    def network(self, index, tenant_id):
+        name = get_name('net', index)
+        for net in self.os_clients.network.list_networks(
+                name=name)['networks']:
+            if net['admin_state_up'] and net['status'] == 'ACTIVE':
+                logger.info("Reusing network {}".format(name))
+                return net
+            logger.info("Network {} is {}, recreating".format(
+                name, net['status']))
+            # the router interface ports are deleted by the router only
+            for port in self.os_clients.network.list_ports(
+                    network_id=net['id'],
+                    device_owner='network:router_interface')['ports']:
+                self.os_clients.network.remove_interface_router(
+                    port['device_id'], {'port_id': port['id']})
+            self.os_actions.wait_for_ports_deleted(network_id=net['id'])
+            self.os_clients.network.delete_network(net['id'])
+        return self.os_actions.create_network(tenant_id, name=name)
+
+    def subnet(self, net, tenant_id, cidr):
+        for subnet in self.os_clients.network.list_subnets(
+                network_id=net['id'])['subnets']:
+            if subnet['cidr'] == cidr:
+                return subnet
+        return self.os_actions.create_subnet(net, tenant_id, cidr)
+
+    def ext_net(self):
+        """The external network, the fake one has a fixed name to be
+        reused by the next runs."""
+        return self.os_actions.get_external_network(
+            fake_name=get_name('ext-net'))
+
+    def router(self, ext_net, tenant_id):
+        name = get_name('router')
+        network = self.os_clients.network
+        for router in network.list_routers(name=name)['routers']:
+            gateway = router.get('external_gateway_info') or {}
+            if gateway.get('network_id') != ext_net['id']:
+                logger.info("Setting the gateway of router {} to {}".format(
+                    name, ext_net['name']))
+                network.add_gateway_router(router['id'],
+                                           {'network_id': ext_net['id']})
+            logger.info("Reusing router {}".format(name))
+            return router
+        return self.os_actions.create_router(ext_net, tenant_id, name=name)
+
+    def router_interface(self, router, subnet_id):
+        for port in self.os_clients.network.list_ports(
+                device_id=router['id'])['ports']:
+            if any(ip['subnet_id'] == subnet_id for ip in port['fixed_ips']):
+                return port
+        return self.os_clients.network.add_interface_router(
+            router['id'], {'subnet_id': subnet_id})
+
+    def servers(self, names, image_id, keypair_name, private_key,
+                user='ubuntu', probe_timeout=60):
+        """Find the healthy servers by names, the broken ones are deleted.
+        The servers with a floating IP are probed via SSH, the ones not
+        reachable in probe_timeout seconds are broken too.
+        :return: dict of name: server, None if it should be created
+        """
+        found = dict.fromkeys(names)
+        broken = []
+        for server in self.os_clients.compute.servers.list(
+                search_opts={'name': get_name('server')}):
+            if server.name not in found:
+                continue
+            if server.status == 'ACTIVE' and \
+                    server.image['id'] == image_id and \
+                    server.key_name == keypair_name:
+                found[server.name] = server
+            else:
+                logger.info("VM {} is {}, recreating".format(
+                    server.name, server.status))
+                broken.append(server)
+        fips = {get_floating_ip(server): server
+                for server in found.values() if server is not None}
+        fips.pop(None, None)
+        reachability = probe.probe_all(list(fips), user, private_key,
+                                       timeout=probe_timeout)
+        for fip, result in reachability.items():
+            if not result.reachable:
+                server = fips[fip]
+                logger.info("VM {} is not reachable via SSH at {}, "
+                            "recreating: {}".format(server.name, fip,
+                                                    result.error))
+                ssh.connection_pool.close(fip)
+                found[server.name] = None
+                broken.append(server)
+        for server in found.values():
+            if server is not None:
+                logger.info("Reusing VM {}".format(server.name))
+        if broken:
+            self.os_actions.delete_servers(broken,
+                                           name_filter=get_name('server'))
+        return found
+
+    def floating_ip(self, server, ext_net_name):
+        """Floating IP of the server, a new one is associated if none."""
+        address = get_floating_ip(server)
+        if address:
+            return address
+        fip = self.os_clients.compute.floating_ips.create(ext_net_name)
+        server.add_floating_ip(fip)
+        return fip.ip
+
+    def purge(self):
+        """Delete all the persistent resources."""
+        compute = self.os_clients.compute
+        network = self.os_clients.network
+        servers = compute.servers.list(
+            search_opts={'name': get_name('server')})
+        logger.info("Deleting VMs {}".format(
+            ", ".join(server.name for server in servers)))
+        self.os_actions.delete_servers(servers,
+                                       name_filter=get_name('server'))
+        for router in network.list_routers(
+                name=get_name('router'))['routers']:
+            logger.info("Deleting router {}".format(router['name']))
+            for port in network.list_ports(
+                    device_id=router['id'],
+                    device_owner='network:router_interface')['ports']:
+                network.remove_interface_router(router['id'],
+                                                {'port_id': port['id']})
+            if router.get('external_gateway_info'):
+                network.remove_gateway_router(router['id'])
+            # the router is deleted with its ports only once they are gone
+            self.os_actions.wait_for_ports_deleted(
+                device_id=router['id'],
+                ignored_owners=('network:router_ha_interface',))
+            network.delete_router(router['id'])
+        for name in (get_name('net', 1), get_name('net', 2),
+                     get_name('ext-net')):
+            for net in network.list_networks(name=name)['networks']:
+                logger.info("Deleting network {}".format(net['name']))
+                self.os_actions.wait_for_ports_deleted(network_id=net['id'])
+                network.delete_network(net['id'])
+        for secgroup in compute.security_groups.list():
+            if secgroup.name == get_name('secgroup'):
+                logger.info("Deleting security group {}".format(
+                    secgroup.name))
+                compute.security_groups.delete(secgroup.id)
+        for keypair in compute.keypairs.list():
+            if keypair.name == get_name('key'):
+                logger.info("Deleting key pair {}".format(keypair.name))
+                compute.keypairs.delete(keypair.name)
+        if os.path.exists(self.key_path):
+            os.remove(self.key_path)
+
+
+def main(argv):
+    if argv[1:] != ['purge']:
+        print("Usage: python -m utils.persistent purge")
+        return 1
+    logging.basicConfig(level=logging.INFO)
+    openstack_clients = os_client.OfficialClientManager(
+        username=os.environ['OS_USERNAME'],
+        password=os.environ['OS_PASSWORD'],
+        tenant_name=os.environ['OS_PROJECT_NAME'],
+        auth_url=os.environ['OS_AUTH_URL'],
+        cert=False,
+        domain=os.environ['OS_PROJECT_DOMAIN_NAME']
+    )
+    PersistentResources(
+        os_client.OSCliActions(openstack_clients),
+        utils.get_configuration().persistent_state_dir).purge()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,116 @@
+"""Readiness probing of many VMs via SSH at the same time.
+
+Each VM goes through the cheap stages first: TCP connect to port 22, then
+the SSH banner read, and the full key authentication only once the banner
+is there. The failed attempts are retried with the jittered exponential
+backoff. The authenticated connection is kept in ssh.connection_pool, so
+the next commands at the VM reuse it.
+"""
+import asyncio
+from collections import namedtuple
+from concurrent import futures
+from io import StringIO
+import logging
+import random
+import time
+
+import paramiko
+
+from utils import ssh
+
+logger = logging.getLogger(__name__)
+
+ProbeResult = namedtuple('ProbeResult', [
+    'address',
+    'reachable',    # True if all the stages passed
+    'seconds',      # time to reachable from the start, None if not
+    'stages',       # dict of the passed stage (tcp, banner, auth):
+                    # seconds from the start
+    'attempts',
+    'error',        # the last error if not reachable
+])
+
+
+def get_backoff(attempt, base_delay=1.0, max_delay=10.0):
+    """Full jitter: random delay up to the exponentially growing cap."""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+async def probe(address, username, private_key, executor, timeout=500,
+                start=None, port=22, attempt_timeout=10.0):
+    """Wait for the VM to accept the SSH key authentication.
+    :param private_key: paramiko.RSAKey
+    :param executor: executor to run the blocking authentication in
+    :param start: timestamp to count the time to reachable from, e.g. the
+    VM boot request, now by default
+    :rtype: ProbeResult
+    """
+    loop = asyncio.get_event_loop()
+    start = start or time.time()
+    deadline = time.time() + timeout
+    stages = {}
+    attempt = 0
+    error = None
+    while True:
+        attempt += 1
+        try:
+            if 'banner' not in stages:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(address, port), attempt_timeout)
+                stages.setdefault('tcp', time.time() - start)
+                try:
+                    banner = await asyncio.wait_for(reader.readline(),
+                                                    attempt_timeout)
+                finally:
+                    writer.close()
+                if not banner.startswith(b'SSH-'):
+                    raise paramiko.SSHException(
+                        "Not an SSH banner: {!r}".format(banner[:100]))
+                stages['banner'] = time.time() - start
+            await loop.run_in_executor(
+                executor, lambda: ssh.connection_pool.get(
+                    address, username, private_key=private_key,
+                    timeout=attempt_timeout))
+            stages['auth'] = time.time() - start
+            logger.info("VM with FIP {} is reachable via SSH in {:.1f} s "
+                        "({} attempts).".format(address, stages['auth'],
+                                                attempt))
+            return ProbeResult(address, True, stages['auth'], stages,
+                               attempt, None)
+        except Exception as e:
+            error = e
+        delay = get_backoff(attempt)
+        if time.time() + delay > deadline:
+            logger.info("VM with FIP {} is not reachable via SSH, passed "
+                        "stages: {}. See details: {}".format(
+                            address, ", ".join(stages) or 'none', error))
+            return ProbeResult(address, False, None, stages, attempt, error)
+        logger.debug("VM with FIP {} is not reachable via SSH yet ({}), "
+                     "retry after {:.1f} seconds.".format(address, error,
+                                                          delay))
+        await asyncio.sleep(delay)
+
+
+def probe_all(addresses, username, private_key, timeout=500, start=None,
+              max_auth_workers=8):
+    """Probe all the VMs concurrently.
+    :param private_key: private key string
+    :return: dict of the address: ProbeResult
+    """
+    if not addresses:
+        return {}
+    key = paramiko.RSAKey.from_private_key(StringIO(private_key))
+
+    async def run_all(pool):
+        return await asyncio.gather(*[
+            probe(address, username, key, pool, timeout=timeout,
+                  start=start) for address in addresses])
+
+    loop = asyncio.new_event_loop()
+    try:
+        with futures.ThreadPoolExecutor(
+                max_workers=min(max_auth_workers, len(addresses))) as pool:
+            results = loop.run_until_complete(run_all(pool))
+    finally:
+        loop.close()
+    return {result.address: result for result in results}
@@ -1,6 +1,10 @@
+from concurrent import futures
 from io import StringIO
 import logging
+import hashlib
 import select
+import socket
+import threading
 import utils
 import paramiko
 import time
@@ -12,6 +16,191 @@ logger = logging.getLogger(__name__)
 logging.getLogger("paramiko").setLevel(logging.WARNING)
 
 
+# SFTP channel window for the bulk copies, bytes
+SFTP_WINDOW_SIZE = 8 * 1024 * 1024
+
+
+class SSHConnectionPool(object):
+    """Keeps one authenticated SSH connection per (address, user, key).
+
+    Exec channels and SFTP sessions are opened over the same paramiko
+    Transport, so the handshake is done once per VM.
+    """
+
+    keepalive_interval = 30
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._key_locks = {}
+
+    @staticmethod
+    def _get_key(address, username, private_key):
+        fingerprint = private_key.get_fingerprint() if private_key else None
+        return address, username, fingerprint
+
+    @staticmethod
+    def is_healthy(client):
+        transport = client.get_transport()
+        if transport is None or not transport.is_active() or \
+                not transport.is_authenticated():
+            return False
+        try:
+            transport.send_ignore()
+        except (EOFError, socket.error, paramiko.SSHException):
+            return False
+        return True
+
+    def get(self, address, username, password=None, private_key=None,
+            timeout=10.0):
+        key = self._get_key(address, username, private_key)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            client = self._clients.get(key)
+            if client is not None:
+                if self.is_healthy(client):
+                    return client
+                logger.debug("SSH connection to {0} is broken, "
+                             "reconnecting".format(address))
+                client.close()
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            try:
+                client.connect(address, username=username,
+                               password=password, pkey=private_key,
+                               timeout=timeout, look_for_keys=False,
+                               allow_agent=False)
+            except Exception:
+                client.close()
+                self._clients.pop(key, None)
+                raise
+            client.get_transport().set_keepalive(self.keepalive_interval)
+            logger.debug("Successfully connected to: {0}".format(address))
+            self._clients[key] = client
+            return client
+
+    def invalidate(self, address, username, private_key=None):
+        key = self._get_key(address, username, private_key)
+        with self._lock:
+            client = self._clients.pop(key, None)
+        if client is not None:
+            client.close()
+
+    def close(self, address=None):
+        """Close the pooled connections to the address, or all of them."""
+        with self._lock:
+            keys = [key for key in self._clients
+                    if address is None or key[0] == address]
+            clients = [self._clients.pop(key) for key in keys]
+        for client in clients:
+            client.close()
+        if clients:
+            logger.debug("Closed {0} SSH connection(s)".format(len(clients)))
+
+
+connection_pool = SSHConnectionPool()
+
+
+class CommandStream(object):
+    """Output of the command executed at the SSH channel.
+
+    The output is read as it arrives: chunks() yields the raw
+    ('stdout' | 'stderr', bytes) chunks, iterating over the object yields
+    the complete lines of the streams. The receive buffer grows while the
+    channel keeps filling it and shrinks back on a slow output. The exit
+    status is available in exit_status after the stream is consumed.
+    """
+
+    max_buf_size = 64 * 1024
+    max_line_size = 1024 * 1024
+    poll_interval = 1.0
+
+    def __init__(self, channel, cmd, timeout=None, line_callback=None,
+                 buf_size=1024):
+        self.channel = channel
+        self.cmd = cmd
+        self.timeout = timeout
+        self.line_callback = line_callback
+        self.min_buf_size = buf_size
+        self.exit_status = None
+
+    def _adapt(self, buf_size, received):
+        if received >= buf_size:
+            return min(buf_size * 2, self.max_buf_size)
+        if received < buf_size // 4:
+            return max(buf_size // 2, self.min_buf_size)
+        return buf_size
+
+    def chunks(self):
+        channel = self.channel
+        readers = {'stdout': (channel.recv_ready, channel.recv),
+                   'stderr': (channel.recv_stderr_ready,
+                              channel.recv_stderr)}
+        buf_sizes = dict.fromkeys(readers, self.min_buf_size)
+        deadline = time.time() + self.timeout if self.timeout else None
+        poll = select.poll()
+        poll.register(channel, select.POLLIN)
+        try:
+            while True:
+                # checked before reading, the commands printing all the
+                # time are timed out too
+                if deadline is not None and time.time() > deadline:
+                    raise TimeoutError(
+                        "Command '{}' is not finished in {} seconds"
+                        "".format(self.cmd, self.timeout))
+                received = False
+                for name, (is_ready, recv) in readers.items():
+                    if not is_ready():
+                        continue
+                    chunk = recv(buf_sizes[name])
+                    buf_sizes[name] = self._adapt(buf_sizes[name],
+                                                  len(chunk))
+                    if chunk:
+                        received = True
+                        yield name, chunk
+                if received:
+                    continue
+                # the exit status is not flow controlled and can come
+                # before the last output, so the end of the output is EOF
+                if channel.eof_received or channel.closed:
+                    if not channel.recv_ready() and \
+                            not channel.recv_stderr_ready():
+                        break
+                    continue
+                wait = self.poll_interval
+                if deadline is not None:
+                    wait = max(min(wait, deadline - time.time()), 0)
+                # stderr data does not wake the poll up, so the wait is
+                # limited by poll_interval
+                poll.poll(int(wait * 1000))
+            self.exit_status = channel.recv_exit_status()
+        finally:
+            channel.close()
+
+    def close(self):
+        """Stop reading, the command gets SIGPIPE on its next write."""
+        self.channel.close()
+
+    def __iter__(self):
+        partial = {'stdout': b'', 'stderr': b''}
+        for name, chunk in self.chunks():
+            lines = (partial[name] + chunk).split(b'\n')
+            partial[name] = lines.pop()
+            if len(partial[name]) > self.max_line_size:
+                lines.append(partial[name])
+                partial[name] = b''
+            for line in lines:
+                if self.line_callback is not None:
+                    self.line_callback(name, line)
+                yield name, line
+        for name, line in partial.items():
+            if line:
+                if self.line_callback is not None:
+                    self.line_callback(name, line)
+                yield name, line
+
+
 class SSHTransport(object):
     def __init__(self, address, username, password=None,
                  private_key=None, look_for_keys=False, *args, **kwargs):
@@ -30,59 +219,56 @@ class SSHTransport(object):
         self.channel_timeout = 10.0
 
     def _get_ssh_connection(self):
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(
-            paramiko.AutoAddPolicy())
-        ssh.connect(self.address, username=self.username,
-                    password=self.password, pkey=self.private_key,
-                    timeout=self.channel_timeout)
-        logger.debug("Successfully connected to: {0}".format(self.address))
-        return ssh
-
-    def _get_sftp_connection(self):
-        transport = paramiko.Transport((self.address, 22))
-        transport.connect(username=self.username,
-                          password=self.password,
-                          pkey=self.private_key)
-
-        return paramiko.SFTPClient.from_transport(transport)
-
-    def exec_sync(self, cmd):
+        return connection_pool.get(self.address, self.username,
+                                   password=self.password,
+                                   private_key=self.private_key,
+                                   timeout=self.channel_timeout)
+
+    def _open_session(self):
+        try:
+            return self._get_ssh_connection().get_transport().open_session()
+        except (EOFError, socket.error, paramiko.SSHException) as e:
+            logger.debug("Could not open a channel to {0}: {1}. "
+                         "Reconnecting".format(self.address, e))
+            connection_pool.invalidate(self.address, self.username,
+                                       self.private_key)
+            return self._get_ssh_connection().get_transport().open_session()
+
+    def _get_sftp_connection(self, window_size=None):
+        return paramiko.SFTPClient.from_transport(
+            self._get_ssh_connection().get_transport(),
+            window_size=window_size)
+
+    def close(self):
+        connection_pool.invalidate(self.address, self.username,
+                                   self.private_key)
+
+    def exec_stream(self, cmd, timeout=None, line_callback=None):
+        """Start the command and return its CommandStream.
+        :param timeout: overall deadline for the command, seconds
+        :param line_callback: called as line_callback(stream, line) for
+        every complete line while iterating over the lines
+        """
         logger.debug("Executing {0} on host {1}".format(cmd, self.address))
-        ssh = self._get_ssh_connection()
-        transport = ssh.get_transport()
-        channel = transport.open_session()
-        channel.fileno()
+        channel = self._open_session()
         channel.exec_command(cmd)
         channel.shutdown_write()
-        out_data = []
-        err_data = []
-        poll = select.poll()
-        poll.register(channel, select.POLLIN)
+        return CommandStream(channel, cmd, timeout=timeout,
+                             line_callback=line_callback,
+                             buf_size=self.buf_size)
 
-        while True:
-            ready = poll.poll(self.channel_timeout)
-            if not any(ready):
-                continue
-            if not ready[0]:
-                continue
-            out_chunk = err_chunk = None
-            if channel.recv_ready():
-                out_chunk = channel.recv(self.buf_size)
-                out_data += out_chunk,
-            if channel.recv_stderr_ready():
-                err_chunk = channel.recv_stderr(self.buf_size)
-                err_data += err_chunk,
-            if channel.closed and not err_chunk and not out_chunk:
-                break
-        exit_status = channel.recv_exit_status()
+    def exec_sync(self, cmd, timeout=None):
+        stream = self.exec_stream(cmd, timeout=timeout)
+        data = {'stdout': [], 'stderr': []}
+        for name, chunk in stream.chunks():
+            data[name].append(chunk)
         logger.debug("Command {0} executed with status: {1}"
-                     .format(cmd, exit_status))
-        return (exit_status, b" ".join(out_data).strip(),
-                b" ".join(err_data).strip())
+                     .format(cmd, stream.exit_status))
+        return (stream.exit_status, b"".join(data['stdout']).strip(),
+                b"".join(data['stderr']).strip())
 
-    def exec_command(self, cmd):
-        exit_status, stdout, stderr = self.exec_sync(cmd)
+    def exec_command(self, cmd, timeout=None):
+        exit_status, stdout, stderr = self.exec_sync(cmd, timeout=timeout)
         return stdout
 
     def check_call(self, command, error_info=None, expected=None,
@@ -124,45 +310,86 @@ class SSHTransport(object):
         sftp.put(source_path, destination_path)
         sftp.close()
 
+    def get_md5sums(self, paths):
+        """md5 of the remote files, the missing files are not in the dict.
+        """
+        _, stdout, _ = self.exec_sync("md5sum {} 2>/dev/null".format(
+            " ".join("'{}'".format(path) for path in paths)))
+        md5sums = {}
+        for line in stdout.decode('utf-8', 'replace').splitlines():
+            md5, _, path = line.partition('  ')
+            md5sums[path] = md5
+        return md5sums
+
+    def put_files(self, source_paths, destination_directory,
+                  window_size=SFTP_WINDOW_SIZE):
+        """Copy the local files over one SFTP session. The files with the
+        same md5 at the VM are not copied. paramiko pipelines the writes,
+        the larger channel window keeps more of them in flight.
+        :return: list of the copied source paths
+        """
+        destinations = {
+            path: "{}/{}".format(destination_directory.rstrip('/'),
+                                 os.path.basename(path))
+            for path in source_paths}
+        remote_md5sums = self.get_md5sums(destinations.values())
+        to_copy = [path for path in source_paths
+                   if remote_md5sums.get(destinations[path]) != get_md5(path)]
+        if not to_copy:
+            logger.info("The files are already at {}".format(self.address))
+            return []
+        sftp = self._get_sftp_connection(window_size=window_size)
+        try:
+            for path in to_copy:
+                sftp.put(path, destinations[path])
+        finally:
+            sftp.close()
+        return to_copy
+
     def put_iperf3_deb_packages_at_vms(self, source_directory,
                                        destination_directory):
-        iperf_deb_files = [f for f in os.listdir(source_directory)
-                           if "deb" in f]
-        if not iperf_deb_files:
-            raise BaseException(
-                "iperf3 *.deb packages are not found locally at path {}. "
-                "Please recheck 'iperf_deb_package_dir_path' variable in "
-                "global_config.yaml and check *.deb packages are manually "
-                "copied there.".format(source_directory))
-        for f in iperf_deb_files:
-            source_abs_path = "{}/{}".format(source_directory, f)
-            dest_abs_path = "{}/{}".format(destination_directory, f)
-            self.put_file(source_abs_path, dest_abs_path)
+        self.put_files(get_deb_packages(source_directory),
+                       destination_directory)
 
     def get_file(self, source_path, destination_path):
         sftp = self._get_sftp_connection()
         sftp.get(source_path, destination_path)
         sftp.close()
 
+    def check_iperf_server_is_listening(self, port=5201, timeout=60,
+                                        sleep=1):
+        _start_time = time.time()
+        while True:
+            exit_status, _, _ = self.exec_sync(
+                "ss -ltn | grep -q ':{} '".format(port))
+            if exit_status == 0:
+                logger.info("iperf3 server is listening at {}:{}"
+                            "".format(self.address, port))
+                return True
+            if self._is_timed_out(_start_time, timeout):
+                raise TimeoutError(
+                    "iperf3 server is not listening at {}:{} after {} "
+                    "seconds.".format(self.address, port, timeout))
+            time.sleep(sleep)
+
     def _is_timed_out(self, start_time, timeout):
         return (time.time() - timeout) > start_time
 
     def check_vm_is_reachable_ssh(self, floating_ip, timeout=500, sleep=5):
         bsleep = sleep
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
         _start_time = time.time()
         attempts = 0
         while True:
             try:
-                ssh.connect(floating_ip, username=self.username,
-                            password=self.password, pkey=self.private_key,
-                            timeout=self.channel_timeout)
+                # the connection is kept in the pool for the next commands
+                connection_pool.get(floating_ip, self.username,
+                                    password=self.password,
+                                    private_key=self.private_key,
+                                    timeout=self.channel_timeout)
                 logger.info("VM with FIP {} is reachable via SSH. Success!"
                             "".format(floating_ip))
                 return True
             except Exception as e:
-                ssh.close()
                 if self._is_timed_out(_start_time, timeout):
                     logger.info("VM with FIP {} is not reachable via SSH. "
                                 "See details: {}".format(floating_ip, e))
@@ -177,28 +404,123 @@ class SSHTransport(object):
                 time.sleep(bsleep)
 
 
+def get_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(1024 * 1024), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def get_deb_packages(source_directory):
+    iperf_deb_files = [f for f in os.listdir(source_directory)
+                       if "deb" in f]
+    if not iperf_deb_files:
+        raise BaseException(
+            "iperf3 *.deb packages are not found locally at path {}. "
+            "Please recheck 'iperf_deb_package_dir_path' variable in "
+            "global_config.yaml and check *.deb packages are manually "
+            "copied there.".format(source_directory))
+    return [os.path.join(source_directory, f) for f in iperf_deb_files]
+
+
+def _relay_files(seed, peers, source_paths, destination_directory,
+                 private_key, user):
+    """Copy the files from the seed VM to the peers over the tenant
+    network with scp, all the peers at the same time. The key is removed
+    from the seed VM afterwards.
+    :param seed: SSHTransport of the VM which has the files already
+    :param peers: private addresses of the other VMs
+    """
+    key_path = '/tmp/spt-relay-key'
+    files = " ".join("{}/{}".format(destination_directory.rstrip('/'),
+                                    os.path.basename(path))
+                     for path in source_paths)
+    scp = ("scp -q -o StrictHostKeyChecking=no "
+           "-o UserKnownHostsFile=/dev/null -i {key} {files} "
+           "{user}@{{peer}}:{dest}/".format(
+               key=key_path, files=files, user=user,
+               dest=destination_directory.rstrip('/')))
+    cmd = ('pids=""; ' +
+           "".join("{} & pids=\"$pids $!\"; ".format(scp.format(peer=peer))
+                   for peer in peers) +
+           'rc=0; for pid in $pids; do wait $pid || rc=1; done; exit $rc')
+    try:
+        sftp = seed._get_sftp_connection()
+        try:
+            with sftp.file(key_path, 'w') as key_file:
+                key_file.write(private_key)
+            sftp.chmod(key_path, 0o600)
+        finally:
+            sftp.close()
+        exit_status, _, stderr = seed.exec_sync(cmd)
+    finally:
+        # also when the key upload or the copy failed half way
+        try:
+            seed.exec_sync('rm -f {}'.format(key_path))
+        except Exception as e:
+            logger.warning("Could not remove {} from {}: {}".format(
+                key_path, seed.address, e))
+    if exit_status != 0:
+        logger.warning("Relay from {} failed for some VMs, they get the "
+                       "files directly: {}".format(
+                           seed.address, stderr.decode('utf-8', 'replace')))
+
+
+def distribute_files(fips, source_paths, destination_directory,
+                     private_key, user='ubuntu', max_workers=8,
+                     relay_addresses=None):
+    """Copy the local files to all the VMs in parallel, one SFTP session
+    per VM, the VMs which have the same files already are skipped.
+    :param relay_addresses: dict of the FIP: private address. If set, the
+    files are uploaded to the first VM only, and it copies them to the
+    other VMs over the tenant network. The VMs which did not get the files
+    this way get them directly.
+    """
+    transports = {fip: SSHTransport(fip, user, private_key=private_key)
+                  for fip in fips}
+    if relay_addresses and len(fips) > 1:
+        seed = transports[fips[0]]
+        seed.put_files(source_paths, destination_directory)
+        _relay_files(seed, [relay_addresses[fip] for fip in fips[1:]],
+                     source_paths, destination_directory, private_key,
+                     user)
+
+    def put(fip):
+        copied = transports[fip].put_files(source_paths,
+                                           destination_directory)
+        if copied:
+            logger.info("Copied {} files to {}".format(len(copied), fip))
+
+    run_at_vms(put, fips, max_workers, action='copy the files to')
+
+
 class prepare_iperf(object):
 
     def __init__(self, fip, user='ubuntu', password='password',
-                 private_key=None):
+                 private_key=None, packages_copied=False):
 
         transport = SSHTransport(fip, user, password, private_key)
         config = utils.get_configuration()
 
-        # Install iperf3 using apt or downloaded deb package
-        internet_at_vms = utils.get_configuration().get("internet_at_vms")
-        if internet_at_vms.lower() == 'false':
+        # Install iperf3 using apt or downloaded deb package, the VMs kept
+        # from the previous runs have it already
+        exit_status, _, _ = transport.exec_sync('dpkg -s iperf3')
+        if exit_status == 0:
+            logger.info("iperf3 is already installed at {}".format(fip))
+        elif not config.internet_at_vms:
             logger.info("Copying offline iperf3 deb packages, installing...")
-            path_to_iperf_deb = (config.get('iperf_deb_package_dir_path') or
+            path_to_iperf_deb = (config.iperf_deb_package_dir_path or
                                  "/artifacts/mos-spt/")
             home_ubuntu = "/home/ubuntu/"
-            transport.put_iperf3_deb_packages_at_vms(path_to_iperf_deb,
-                                                     home_ubuntu)
+            if not packages_copied:
+                transport.put_iperf3_deb_packages_at_vms(path_to_iperf_deb,
+                                                         home_ubuntu)
             transport.exec_command('sudo dpkg -i {}*.deb'.format(home_ubuntu))
         else:
             logger.info("Installing iperf3 using apt")
-            preparation_cmd = config.get('iperf_prep_string') or ['']
-            transport.exec_command(preparation_cmd)
+            if config.iperf_prep_string:
+                transport.exec_command(config.iperf_prep_string)
             transport.exec_command('sudo apt-get update;'
                                    'sudo apt-get install -y iperf3')
 
@@ -206,5 +528,75 @@ class prepare_iperf(object):
         check = transport.exec_command('dpkg -l | grep iperf3')
         logger.debug(check.decode('utf-8'))
 
-        # Staring iperf server
-        transport.exec_command('nohup iperf3 -s > file 2>&1 &')
+        # Staring iperf server if it is not running yet
+        exit_status, _, _ = transport.exec_sync("ss -ltn | grep -q ':5201 '")
+        if exit_status != 0:
+            transport.exec_command('nohup iperf3 -s > file 2>&1 &')
+        transport.check_iperf_server_is_listening()
+
+
+def run_concurrently(func, items, max_workers=8, action='prepare',
+                     kind='VMs', describe="VM with FIP {}".format):
+    """Call func(item) for all the items concurrently.
+    :param kind: plural name of the items for the error message
+    :param describe: name of one item for the log
+    :return: list of the results in the order of the items
+    :raises Exception: with the errors of all the failed items
+    """
+    results = [None] * len(items)
+    errors = []
+    with futures.ThreadPoolExecutor(
+            max_workers=max(min(max_workers, len(items)), 1)) as executor:
+        tasks = {executor.submit(func, item): index
+                 for index, item in enumerate(items)}
+        for task in futures.as_completed(tasks):
+            item = items[tasks[task]]
+            try:
+                results[tasks[task]] = task.result()
+            except Exception as e:
+                logger.error("Failed to {} {}: {}"
+                             "".format(action, describe(item), e))
+                errors.append((item, e))
+    if errors:
+        raise Exception(
+            "Failed to {} {} of {} {}: {}".format(
+                action, len(errors), len(items), kind,
+                "; ".join("{}: {}".format(describe(item), e)
+                          for item, e in errors)))
+    return results
+
+
+def run_at_vms(func, fips, max_workers=8, action='prepare'):
+    """Call func(fip) for all the VMs concurrently.
+    :raises Exception: with the errors of all the failed VMs
+    """
+    run_concurrently(func, fips, max_workers, action=action)
+
+
+def prepare_vms(fips, private_key, user='ubuntu', max_workers=8,
+                relay_addresses=None):
+    """Prepare iperf3 at all the VMs concurrently. The VMs are expected to
+    be reachable via SSH already, see probe.probe_all. Returns when iperf3
+    server is listening at every VM.
+    :param fips: list of the floating IPs of the VMs
+    :param max_workers: how many VMs are prepared at the same time
+    :param relay_addresses: dict of the FIP: private address to relay the
+    offline iperf3 packages between the VMs, see distribute_files
+    """
+    def prepare(fip):
+        prepare_iperf(fip, user=user, private_key=private_key,
+                      packages_copied=packages_copied)
+        logger.info("VM with FIP {} is prepared.".format(fip))
+
+    config = utils.get_configuration()
+    # the pre-built image has iperf3 installed already
+    packages_copied = not (config.internet_at_vms or
+                           config.iperf_image_prebuilt)
+    if packages_copied:
+        logger.info("Copying offline iperf3 deb packages to all VMs...")
+        distribute_files(
+            fips, get_deb_packages(config.iperf_deb_package_dir_path or
+                                   "/artifacts/mos-spt/"),
+            "/home/ubuntu/", private_key, user=user,
+            max_workers=max_workers, relay_addresses=relay_addresses)
+    run_at_vms(prepare, fips, max_workers)
@@ -0,0 +1,66 @@
+"""Sweep of the iperf3 parameters at one path.
+
+Each dimension is swept on its own with the other parameters at the
+iperf3 defaults, so the count of the measurements is the sum and not the
+product of the dimension sizes:
+
+* parallel - count of the parallel TCP streams (-P)
+* window - TCP window size (-w)
+* tcp_length - size of the TCP writes (-l)
+* udp_length - UDP datagram size (-u -l) at udp_bandwidth (-b)
+
+The throughput is recorded for every value, and the packets per second
+for the UDP ones, iperf3 counts the packets of UDP only. The knee of
+the throughput curve is the value after which it stops growing.
+"""
+from collections import namedtuple
+import logging
+
+from utils import iperf
+
+logger = logging.getLogger(__name__)
+
+DIMENSIONS = ('parallel', 'window', 'tcp_length', 'udp_length')
+
+OPTIONS = {
+    'parallel': '-P {value}',
+    'window': '-w {value}',
+    'tcp_length': '-l {value}',
+    'udp_length': '-u -b {udp_bandwidth} -l {value}',
+}
+
+SweepPoint = namedtuple('SweepPoint', [
+    'dimension', 'value', 'bits_per_second', 'pps', 'result'])
+
+
+def get_grid(config):
+    """List of (dimension, values) of the configured dimensions."""
+    return [(dimension, config['sweep_' + dimension])
+            for dimension in DIMENSIONS if config['sweep_' + dimension]]
+
+
+def run_sweep(transport, server, grid, iperf_time=10, udp_bandwidth='1G'):
+    """Measure the path for every value of every dimension.
+    :return: dict of the dimension: list of SweepPoint
+    """
+    curves = {}
+    for dimension, values in grid:
+        curves[dimension] = []
+        for value in values:
+            options = OPTIONS[dimension].format(value=value,
+                                                udp_bandwidth=udp_bandwidth)
+            logger.info("Sweep {} to {}: {}".format(
+                transport.address, server, options))
+            result = iperf.run_iperf(transport, server, iperf_time, options)
+            curves[dimension].append(SweepPoint(
+                dimension, value, result.bits_per_second,
+                iperf.get_pps(result), result))
+    return curves
+
+
+def get_knees(curves, min_gain=0.1):
+    """dict of the dimension: value at the knee of the throughput curve,
+    None if the throughput grows up to the last value."""
+    return {dimension: iperf.find_knee(
+        [(point.value, point.bits_per_second) for point in points],
+        min_gain=min_gain) for dimension, points in curves.items()}
@@ -0,0 +1,266 @@
+import logging
+import time
+
+import utils
+from utils import os_client
+from utils import persistent
+from utils import probe
+from utils import ssh
+
+logger = logging.getLogger(__name__)
+
+
+class Topology(object):
+    """VMs placed at the compute hosts by get_roles().
+
+    All the VMs have floating IPs and iperf3 server running, unless
+    created with prepare_iperf=False.
+
+    With os_resources['persistent'] the VMs are kept per compute host
+    between the runs: the healthy ones are reused, only the missing or
+    broken ones are created, and nothing is deleted after the tests.
+    """
+
+    def __init__(self, os_clients, compute_hosts, os_resources,
+                 user='ubuntu'):
+        self.os_clients = os_clients
+        self.os_actions = os_client.OSCliActions(os_clients)
+        self.compute_hosts = compute_hosts
+        self.os_resources = os_resources
+        self.user = user
+        self.private_key = os_resources['keypair'].private_key
+        self.warm = os_resources.get('persistent')
+        self.vms = []
+        self.fips = []
+        self.vm_info = []
+
+    def get_roles(self):
+        """List of (net, host, slot of the VM of the net at the host)."""
+        raise NotImplementedError
+
+    def create(self, nova_timeout=300, ssh_timeout=500,
+               vm_prepare_workers=8, prepare_iperf=True):
+        """Boot the VMs, associate FIPs and prepare iperf3 at them.
+        :param prepare_iperf: False to only wait for SSH at the VMs, for
+        the tests which do not use iperf3
+        """
+        os_resources = self.os_resources
+        services = self.os_clients.compute.services.list()
+        zones = {service.host: service.zone for service in services
+                 if service.host in self.compute_hosts}
+
+        roles = self.get_roles()
+        servers_args = []
+        for net, host, slot in roles:
+            servers_args.append({
+                'image': os_resources['image_id'],
+                'flavor': os_resources['flavor_id'],
+                'net': os_resources[net],
+                'availability_zone': '{0}:{1}'.format(zones[host], host),
+                'sec_groups': [os_resources['sec_group'].name],
+                'keypair': os_resources['keypair'].name})
+        name_filter = 'spt-test-server-'
+        reused = [None] * len(roles)
+        if self.warm is not None:
+            name_filter = persistent.get_name('server')
+            for args, (net, host, slot) in zip(servers_args, roles):
+                args['name'] = persistent.get_name('server', host, net, slot)
+            found = self.warm.servers([args['name'] for args in servers_args],
+                                      os_resources['image_id'],
+                                      os_resources['keypair'].name,
+                                      self.private_key, user=self.user)
+            reused = [found[args['name']] for args in servers_args]
+
+        # create the missing VMs at the same time
+        boot_time = time.time()
+        to_create = [args for args, vm in zip(servers_args, reused)
+                     if vm is None]
+        logger.info("Creating {} VMs at {}...".format(
+            len(to_create), ", ".join(self.compute_hosts)))
+        created = iter(self.os_actions.create_servers(to_create))
+        self.vms = [vm if vm is not None else next(created)
+                    for vm in reused]
+        for vm in self.vms:
+            logger.info("Using VM {}.".format(vm.id))
+
+        # Wait for all VMs to be Active, associate FIPs
+        active_vms = self.os_actions.check_vms_are_active(
+            [vm.id for vm in self.vms], timeout=nova_timeout,
+            name_filter=name_filter)
+        self.vms = [active_vms[vm.id] for vm in self.vms]
+        logger.info("Creating Floating IPs and associating them...")
+        for vm in self.vms:
+            if self.warm is not None:
+                fip_address = self.warm.floating_ip(
+                    vm, os_resources['ext_net']['name'])
+            else:
+                fip = self.os_clients.compute.floating_ips.create(
+                    os_resources['ext_net']['name'])
+                self.fips.append(fip.id)
+                vm.add_floating_ip(fip)
+                fip_address = fip.ip
+            private_address = [
+                address['addr'] for addresses in vm.addresses.values()
+                for address in addresses
+                if address.get('OS-EXT-IPS:type', 'fixed') == 'fixed'][0]
+            self.vm_info.append({'vm': vm, 'fip': fip_address,
+                                 'private_address': private_address})
+
+        # Wait for SSH at all VMs at once, count the time from the boot
+        logger.info("Checking VMs are reachable via SSH...")
+        fips = [info['fip'] for info in self.vm_info]
+        reachability = probe.probe_all(fips, self.user, self.private_key,
+                                       timeout=ssh_timeout, start=boot_time)
+        for info in self.vm_info:
+            info['ssh_ready_s'] = reachability[info['fip']].seconds
+            info['ssh_stages'] = reachability[info['fip']].stages
+            logger.info("VM {} ({}): {}".format(
+                info['vm'].id, info['fip'],
+                self.format_ssh_times(info)))
+        unreachable = [result for result in reachability.values()
+                       if not result.reachable]
+        if unreachable:
+            raise TimeoutError(
+                "VMs are not reachable via SSH in {} seconds: {}".format(
+                    ssh_timeout, "; ".join(
+                        "{} (passed stages: {}): {}".format(
+                            result.address,
+                            ", ".join(result.stages) or 'none', result.error)
+                        for result in unreachable)))
+
+        if not prepare_iperf:
+            return
+        logger.info("Preparing iperf3...")
+        relay_addresses = None
+        if utils.get_configuration().iperf_deb_relay:
+            relay_addresses = {info['fip']: info['private_address']
+                               for info in self.vm_info}
+        ssh.prepare_vms([info['fip'] for info in self.vm_info],
+                        self.private_key, user=self.user,
+                        max_workers=vm_prepare_workers,
+                        relay_addresses=relay_addresses)
+
+    @staticmethod
+    def format_ssh_times(info):
+        """Time to reachable via SSH from the boot and of each stage."""
+        stages = ", ".join(
+            "{} {:.1f} s".format(stage, seconds) for stage, seconds in
+            sorted(info['ssh_stages'].items(), key=lambda item: item[1]))
+        if info['ssh_ready_s'] is None:
+            return "not reachable via SSH ({})".format(stages or 'none')
+        return "reachable via SSH in {:.1f} s ({})".format(
+            info['ssh_ready_s'], stages)
+
+    def record_ssh_times(self, record_property):
+        """Record the time to reachable via SSH of each VM."""
+        for index, info in enumerate(self.vm_info):
+            if info.get('ssh_ready_s') is None:
+                continue
+            record_property("VM {} ({}) SSH ready s".format(
+                index + 1, info['vm'].id), info['ssh_ready_s'])
+            for stage, seconds in info['ssh_stages'].items():
+                record_property("VM {} ({}) SSH {} s".format(
+                    index + 1, info['vm'].id, stage), seconds)
+
+    def transport(self, index=0):
+        return ssh.SSHTransport(self.vm_info[index]['fip'], self.user,
+                                password='dd', private_key=self.private_key)
+
+    def delete(self, timeout=300):
+        if not self.vms:
+            logger.info("Skipping cleaning, VMs were not created")
+            return
+        for info in self.vm_info:
+            ssh.connection_pool.close(info['fip'])
+        if self.warm is not None:
+            logger.info("Persistent mode, the VMs are kept for the next "
+                        "runs.")
+            self.vms = []
+            self.vm_info = []
+            return
+        logger.info("Removing VMs and FIPs...")
+        try:
+            self.os_actions.delete_servers(self.vms, timeout=timeout)
+        finally:
+            # the FIPs which were not associated
+            compute = self.os_clients.compute
+            for fip in compute.floating_ips.list():
+                if fip.id in self.fips:
+                    compute.floating_ips.delete(fip.id)
+        self.vms = []
+        self.fips = []
+        self.vm_info = []
+
+
+class PairTopology(Topology):
+    """Four VMs at a pair of compute hosts used by the vm2vm tests.
+
+    vm1 and vm2 are at the first host in net1, vm3 is at the second host
+    in net1, vm4 is at the second host in net2 which is connected to net1
+    with the router.
+    """
+
+    # (description, server VM index, server address key)
+    # the client is always vm1
+    PATHS = [
+        ('same node via Private IP', 1, 'private_address'),
+        ('different HW nodes via Private IP', 2, 'private_address'),
+        ('different HW nodes via Floating IP', 2, 'fip'),
+        ('different HW nodes, each VM is in separate network connected '
+         'using Router via Private IP', 3, 'private_address'),
+    ]
+
+    def __init__(self, os_clients, pair, os_resources, user='ubuntu'):
+        super(PairTopology, self).__init__(os_clients, list(pair),
+                                           os_resources, user=user)
+        self.pair = pair
+
+    def get_roles(self):
+        return [('net1', self.pair[0], 0), ('net1', self.pair[0], 1),
+                ('net1', self.pair[1], 0), ('net2', self.pair[1], 0)]
+
+    def hosts(self, index):
+        """Compute hosts of vm1 and of the VM with the index."""
+        return self.pair[0], (self.pair[0] if index < 2 else self.pair[1])
+
+
+class FabricTopology(Topology):
+    """vms_per_host VMs in net1 at each of the compute hosts used by the
+    saturation test. VM i at host h sends to VM i at host h + 1 + i (mod
+    the host count, skipping h), so the flows of a host go to different
+    hosts across the fabric, not only to its neighbour. Each host sends
+    and receives vms_per_host flows and each iperf3 server gets one flow.
+    """
+
+    def __init__(self, os_clients, compute_hosts, os_resources,
+                 vms_per_host=1, user='ubuntu'):
+        super(FabricTopology, self).__init__(os_clients, compute_hosts,
+                                             os_resources, user=user)
+        self.vms_per_host = vms_per_host
+
+    def get_roles(self):
+        return [('net1', host, slot) for host in self.compute_hosts
+                for slot in range(self.vms_per_host)]
+
+    def get_flows(self):
+        """List of (client VM index, server VM index).
+        :raises ValueError: with less than 2 hosts, the flows would not
+        leave the host
+        """
+        count = len(self.compute_hosts)
+        if count < 2:
+            raise ValueError("At least 2 compute hosts are needed for the "
+                             "flows through the fabric, got {}".format(count))
+        flows = []
+        for host in range(count):
+            for slot in range(self.vms_per_host):
+                # the slots of a host send to different hosts, never to
+                # the host itself; for each slot the hosts are shifted by
+                # the same offset, so each VM receives exactly one flow
+                destination = (host + 1 + slot % (count - 1)) % count
+                flows.append((host * self.vms_per_host + slot,
+                              destination * self.vms_per_host + slot))
+        return flows
+
+    def host(self, index):
+        return self.compute_hosts[index // self.vms_per_host]
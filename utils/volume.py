@@ -0,0 +1,312 @@
+"""Cinder volumes attached to the test VMs and the fio jobs at them.
+
+The volumes are created, attached, detached and deleted for all the VMs
+at the same time, the API calls are sent concurrently and the statuses
+are polled for all the volumes together.
+
+Each fio job is run at all the VMs at once, each VM at its own volume
+with direct I/O, so the results show the storage backend under the load
+of all the compute hosts. The completion latency percentiles come from
+fio itself.
+"""
+from collections import namedtuple
+import json
+import logging
+import time
+
+import utils
+from utils import ssh
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'spt-test-volume-'
+PERCENTILES = ('50', '90', '99', '99.9')
+
+FioResult = namedtuple('FioResult', [
+    'rw', 'block_size', 'iodepth',
+    'iops',
+    'bytes_per_second',
+    'clat_ms',      # dict of the percentile name like 'p99': milliseconds
+])
+
+
+def wait_for_volumes(volume_client, volume_ids, expected, timeout=300,
+                     sleep=5):
+    """Poll all the volumes until they are in the expected status, or
+    deleted if expected is None."""
+    start_time = time.time()
+    pending = set(volume_ids)
+    while True:
+        statuses = {volume.id: volume.status.lower()
+                    for volume in volume_client.volumes.list()
+                    if volume.id in pending}
+        if expected is None:
+            pending = set(statuses)
+        else:
+            failed = [volume_id for volume_id, status in statuses.items()
+                      if status.startswith('error')]
+            if failed:
+                raise Exception("Volumes are in error status: {}".format(
+                    ", ".join(failed)))
+            missing = pending - set(statuses)
+            if missing:
+                raise Exception("Volumes are gone: {}".format(
+                    ", ".join(missing)))
+            pending = {volume_id for volume_id, status in statuses.items()
+                       if status != expected}
+        if not pending:
+            return
+        if (time.time() - start_time) > timeout:
+            raise TimeoutError(
+                "Volumes are not {} after {} seconds: {}".format(
+                    expected or 'deleted', timeout, ", ".join(pending)))
+        time.sleep(sleep)
+
+
+def describe_pair(pair):
+    vm, volume = pair
+    return "volume {} of VM {}".format(volume.id, vm.id)
+
+
+def describe_device(pair):
+    transport, device = pair
+    return "{} of VM with FIP {}".format(device, transport.address)
+
+
+class VolumeSet(object):
+    """One volume per VM, created and attached to the VMs."""
+
+    def __init__(self, os_clients, size, volume_type=None, max_workers=8):
+        self.compute = os_clients.compute
+        self.volume_client = os_clients.volume
+        self.size = size
+        self.volume_type = volume_type or None
+        self.max_workers = max_workers
+        self.volumes = []
+        self.attached = []
+
+    def create(self, vms, timeout=300):
+        """Create the volumes and attach each of them to its VM.
+        :return: list of the volumes in the order of the VMs
+        """
+        logger.info("Creating {} volumes of {} GB...".format(
+            len(vms), self.size))
+        created = [None] * len(vms)
+
+        def create(index):
+            created[index] = self.volume_client.volumes.create(
+                self.size, name=PREFIX + vms[index].name,
+                volume_type=self.volume_type)
+
+        try:
+            ssh.run_concurrently(create, list(range(len(vms))),
+                                 self.max_workers, action='create',
+                                 kind='volumes',
+                                 describe=lambda index: "volume of VM {}"
+                                 "".format(vms[index].id))
+        finally:
+            # in the order of the VMs, the ones created before an error
+            # are deleted by delete()
+            self.volumes = [volume for volume in created
+                            if volume is not None]
+        wait_for_volumes(self.volume_client,
+                         [volume.id for volume in self.volumes],
+                         'available', timeout=timeout)
+
+        logger.info("Attaching the volumes to the VMs...")
+
+        def attach(pair):
+            vm, volume = pair
+            self.compute.volumes.create_server_volume(vm.id, volume.id)
+            return pair
+
+        pairs = list(zip(vms, self.volumes))
+        try:
+            ssh.run_concurrently(attach, pairs, self.max_workers,
+                                 action='attach', kind='volumes',
+                                 describe=describe_pair)
+        finally:
+            # the failed attachments may be in progress anyway
+            self.attached = pairs
+        wait_for_volumes(self.volume_client,
+                         [volume.id for volume in self.volumes],
+                         'in-use', timeout=timeout)
+        return self.volumes
+
+    def delete(self, timeout=300):
+        if not self.volumes:
+            return
+        logger.info("Detaching the volumes...")
+
+        def detach(pair):
+            vm, volume = pair
+            try:
+                self.compute.volumes.delete_server_volume(vm.id, volume.id)
+            except Exception as e:
+                logger.info("Could not detach volume {} from VM {}: "
+                            "{}".format(volume.id, vm.id, e))
+
+        ssh.run_concurrently(detach, self.attached, self.max_workers,
+                             action='detach', kind='volumes',
+                             describe=describe_pair)
+        volume_ids = [volume.id for volume in self.volumes]
+        try:
+            wait_for_volumes(self.volume_client, volume_ids, 'available',
+                             timeout=timeout)
+        finally:
+            logger.info("Removing the volumes...")
+            ssh.run_concurrently(self.volume_client.volumes.delete,
+                                 volume_ids, self.max_workers,
+                                 action='delete', kind='volumes',
+                                 describe="volume {}".format)
+        wait_for_volumes(self.volume_client, volume_ids, None,
+                         timeout=timeout)
+        self.volumes = []
+        self.attached = []
+
+
+def get_device(transport, volume_id, timeout=60):
+    """Block device of the attached volume at the VM, found by the volume
+    id which is the virtio disk serial."""
+    path = '/dev/disk/by-id/virtio-{}'.format(volume_id[:20])
+    start_time = time.time()
+    while True:
+        exit_status, stdout, _ = transport.exec_sync(
+            "readlink -f {}".format(path))
+        if exit_status == 0 and stdout.strip():
+            device = stdout.decode('utf-8').strip()
+            if device != path:
+                return device
+        if (time.time() - start_time) > timeout:
+            raise TimeoutError("Volume {} is not seen at VM {} after {} "
+                               "seconds.".format(volume_id,
+                                                 transport.address, timeout))
+        time.sleep(2)
+
+
+def prepare_fio(fips, private_key, user='ubuntu', max_workers=8):
+    """Install fio at all the VMs, the same way as iperf3: using apt or
+    the offline deb packages from fio_deb_package_dir_path."""
+    config = utils.get_configuration()
+    package_dir = '/home/ubuntu/fio/'
+    if not config.internet_at_vms:
+        if not config.fio_deb_package_dir_path:
+            raise Exception("fio_deb_package_dir_path is needed to install "
+                            "fio without the Internet at the VMs")
+        ssh.run_at_vms(
+            lambda fip: ssh.SSHTransport(
+                fip, user, private_key=private_key).exec_command(
+                    "mkdir -p {}".format(package_dir)),
+            fips, max_workers, action='create the fio directory at')
+        ssh.distribute_files(
+            fips, ssh.get_deb_packages(config.fio_deb_package_dir_path),
+            package_dir, private_key, user=user, max_workers=max_workers)
+
+    def install(fip):
+        transport = ssh.SSHTransport(fip, user, private_key=private_key)
+        exit_status, _, _ = transport.exec_sync('dpkg -s fio')
+        if exit_status == 0:
+            return
+        if config.internet_at_vms:
+            transport.exec_command('sudo apt-get update;'
+                                   'sudo apt-get install -y fio')
+        else:
+            transport.exec_command('sudo dpkg -i {}*.deb'.format(
+                package_dir))
+        exit_status, _, stderr = transport.exec_sync('fio --version')
+        if exit_status != 0:
+            raise Exception("fio is not installed at {}: {}".format(
+                fip, stderr))
+
+    ssh.run_at_vms(install, fips, max_workers, action='install fio at')
+
+
+def get_fio_command(device, rw, block_size, iodepth, runtime=30):
+    return ("sudo fio --name=spt --filename={} --rw={} --bs={} "
+            "--iodepth={} --runtime={} --time_based --direct=1 "
+            "--ioengine=libaio --group_reporting --output-format=json "
+            "--percentile_list={}".format(device, rw, block_size, iodepth,
+                                          runtime, ":".join(PERCENTILES)))
+
+
+def parse_fio(output, rw, block_size, iodepth):
+    """FioResult of the fio JSON output. fio 3.x reports the completion
+    latency in nanoseconds (clat_ns), the older ones in microseconds."""
+    job = json.loads(output)['jobs'][0]
+    stats = job['write' if 'write' in rw else 'read']
+    if 'clat_ns' in stats:
+        clat, divider = stats['clat_ns'], 1e6
+    else:
+        clat, divider = stats['clat'], 1e3
+    percentiles = clat.get('percentile', {})
+    clat_ms = {}
+    for percent in PERCENTILES:
+        value = percentiles.get("{:f}".format(float(percent)))
+        clat_ms['p' + percent] = value / divider \
+            if value is not None else None
+    return FioResult(rw, block_size, iodepth, stats['iops'],
+                     stats['bw'] * 1024, clat_ms)
+
+
+def run_fio(transport, device, rw, block_size, iodepth, runtime=30):
+    """Run one fio job at the device of the VM.
+    :rtype: FioResult
+    """
+    logger.info("fio {} bs={} iodepth={} at {}".format(
+        rw, block_size, iodepth, transport.address))
+    exit_status, stdout, stderr = transport.exec_sync(
+        get_fio_command(device, rw, block_size, iodepth, runtime),
+        timeout=runtime + 120)
+    if exit_status != 0:
+        raise Exception("fio failed at {}: {}".format(transport.address,
+                                                      stderr))
+    return parse_fio(stdout.decode('utf-8'), rw, block_size, iodepth)
+
+
+def precondition(transports, devices):
+    """Fill the whole volumes with a sequential write at all the VMs at
+    once. The thin provisioned volumes (RBD, LVM thin) return zeros for
+    the blocks never written without reading the backend, so the read
+    jobs would be measured at the client only."""
+    logger.info("Preconditioning {} volumes...".format(len(devices)))
+
+    def fill(args):
+        transport, device = args
+        exit_status, _, stderr = transport.exec_sync(
+            "sudo fio --name=precondition --filename={} --rw=write "
+            "--bs=1M --iodepth=32 --direct=1 --ioengine=libaio".format(
+                device))
+        if exit_status != 0:
+            raise Exception("fio failed at {}: {}".format(
+                transport.address, stderr))
+
+    ssh.run_concurrently(fill, list(zip(transports, devices)),
+                         max_workers=len(transports),
+                         action='precondition', describe=describe_device)
+
+
+def get_jobs(config):
+    """List of (rw, block size, queue depth) of the configured jobs."""
+    return [(rw, block_size, iodepth) for rw in config.fio_rw
+            for block_size in config.fio_block_sizes
+            for iodepth in config.fio_iodepths]
+
+
+def run_jobs(transports, devices, jobs, runtime=30):
+    """Run each job at all the VMs at the same time, one job after
+    another.
+    :return: list of the lists of FioResult per job, in the order of the
+    transports
+    """
+    results = []
+    for rw, block_size, iodepth in jobs:
+        results.append(ssh.run_concurrently(
+            lambda args: run_fio(args[0], args[1], rw, block_size, iodepth,
+                                 runtime=runtime),
+            list(zip(transports, devices)), max_workers=len(transports),
+            action='run fio at', describe=describe_device))
+    return results
+
+
+def format_bytes(bytes_per_second):
+    return "{:.1f} MiB/s".format(bytes_per_second / 1048576.0)